@@ -2,12 +2,15 @@
 
 import sys
 import argparse
+import atexit
 import lib.sqlite_interface  as misc
 import lib.blastin           as blastin
 import lib.initialize        as initialize
 import lib.meta              as meta
 import lib.query             as query
 import lib.dbtools           as tools
+import lib.bench             as bench
+import lib.index             as index
 
 __version__ = "0.1.1"
 
@@ -24,12 +27,31 @@ def parser(argv=None):
         version='%(prog)s {}'.format(__version__)
     )
 
+    parser.add_argument(
+        '--profile',
+        help="Print the time, rows and calls of each SQL statement on exit",
+        action='store_true',
+        default=False
+    )
+    parser.add_argument(
+        '--profile-json',
+        help="Write the SQL profile (including slow statements) as JSON to FILE",
+        metavar="FILE"
+    )
+    parser.add_argument(
+        '--slow-ms',
+        help="With --profile or --profile-json, log statements slower than "
+             "this with their query plan (default 100)",
+        metavar="MS",
+        type=float,
+        default=100
+    )
+
     # Input parent parser
     _input = argparse.ArgumentParser(add_help=False)
     _input.add_argument(
         '-i', '--input',
-        help="Input file (from stdin)",
-        type=argparse.FileType('r'),
+        help="Input file, optionally gzip, bz2, xz or zstd compressed (default stdin)",
         nargs="*",
         metavar="FILE"
     )
@@ -62,6 +84,12 @@ def parser(argv=None):
     # lib.dbtools parser
     tools.parse(sub, _sqldb)
 
+    # lib.index parser
+    index.parse(sub, _sqldb)
+
+    # lib.bench parser
+    bench.parse(sub, _sqldb)
+
     # Parse arguments
     args = parser.parse_args()
 
@@ -74,10 +102,21 @@ def parser(argv=None):
 
 if __name__ == '__main__':
     args = parser()
-    with misc.open_db(args.sqldb) as con:
+    if(args.profile or args.profile_json):
+        prof = misc.profile(slow=args.slow_ms / 1000)
+        if(args.profile):
+            atexit.register(prof.summary)
+        if(args.profile_json):
+            atexit.register(prof.dump, args.profile_json)
+    # Read-only subcommands run on a snapshot and never block (or are
+    # blocked by) a concurrent writer
+    readonly = getattr(args, 'readonly', False)
+    with misc.open_db(args.sqldb, readonly=readonly) as con:
         # Pass arguments to proper sub-command
         cur = con.cursor()
         cur.execute('pragma shrink_memory')
+        if(readonly):
+            misc.snapshot(cur)
 
         # This is kind of a dirty hack, but I need two cursors, one for select on
         # for insert in update_besthits. So I need to send in the con not just the
@@ -0,0 +1,337 @@
+#! /usr/bin/python3
+
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import shlex
+import sqlite3 as sql
+import subprocess
+import sys
+import tempfile
+import time
+
+import lib.blastin as blastin
+import lib.sqlite_interface as misc
+
+# =========
+# CONSTANTS
+# =========
+
+AMINO_ACIDS = 'ACDEFGHIKLMNPQRSTVWY'
+
+HEADER = '''<?xml version="1.0"?>
+<!DOCTYPE BlastOutput PUBLIC "-//NCBI//NCBI BlastOutput/EN" "http://www.ncbi.nlm.nih.gov/dtd/NCBI_BlastOutput.dtd">
+<BlastOutput>
+  <BlastOutput_program>blastp</BlastOutput_program>
+  <BlastOutput_version>BLASTP 2.2.29+</BlastOutput_version>
+  <BlastOutput_reference>Synthetic report written by blastdbm bench</BlastOutput_reference>
+  <BlastOutput_db>/synthetic/{db}</BlastOutput_db>
+  <BlastOutput_query-ID>Query_1</BlastOutput_query-ID>
+  <BlastOutput_query-def>{first}</BlastOutput_query-def>
+  <BlastOutput_query-len>{first_len}</BlastOutput_query-len>
+  <BlastOutput_param>
+    <Parameters>
+      <Parameters_matrix>BLOSUM62</Parameters_matrix>
+      <Parameters_expect>10</Parameters_expect>
+      <Parameters_gap-open>11</Parameters_gap-open>
+      <Parameters_gap-extend>1</Parameters_gap-extend>
+      <Parameters_filter>F</Parameters_filter>
+    </Parameters>
+  </BlastOutput_param>
+<BlastOutput_iterations>
+'''
+HEADER_ELEMENTS = 16
+
+ITERATION = '''<Iteration>
+  <Iteration_iter-num>{num}</Iteration_iter-num>
+  <Iteration_query-ID>Query_{num}</Iteration_query-ID>
+  <Iteration_query-def>{qdef}</Iteration_query-def>
+  <Iteration_query-len>{qlen}</Iteration_query-len>
+<Iteration_hits>
+'''
+ITERATION_ELEMENTS = 6
+
+HIT = '''<Hit>
+  <Hit_num>{num}</Hit_num>
+  <Hit_id>gnl|BL_ORD_ID|{id}</Hit_id>
+  <Hit_def>synthetic subject {id}</Hit_def>
+  <Hit_accession>{id}</Hit_accession>
+  <Hit_len>{len}</Hit_len>
+  <Hit_hsps>
+'''
+HIT_ELEMENTS = 7
+
+HSP = '''    <Hsp>
+      <Hsp_num>{num}</Hsp_num>
+      <Hsp_bit-score>{bits:.3f}</Hsp_bit-score>
+      <Hsp_score>{score}</Hsp_score>
+      <Hsp_evalue>{evalue:g}</Hsp_evalue>
+      <Hsp_query-from>1</Hsp_query-from>
+      <Hsp_query-to>{length}</Hsp_query-to>
+      <Hsp_hit-from>1</Hsp_hit-from>
+      <Hsp_hit-to>{length}</Hsp_hit-to>
+      <Hsp_query-frame>0</Hsp_query-frame>
+      <Hsp_hit-frame>0</Hsp_hit-frame>
+      <Hsp_identity>{identity}</Hsp_identity>
+      <Hsp_positive>{identity}</Hsp_positive>
+      <Hsp_gaps>0</Hsp_gaps>
+      <Hsp_align-len>{length}</Hsp_align-len>
+      <Hsp_qseq>{qseq}</Hsp_qseq>
+      <Hsp_hseq>{hseq}</Hsp_hseq>
+      <Hsp_midline>{midline}</Hsp_midline>
+    </Hsp>
+'''
+HSP_ELEMENTS = 18
+
+HIT_END = '''  </Hit_hsps>
+</Hit>
+'''
+
+ITERATION_END = '''</Iteration_hits>
+  <Iteration_stat>
+    <Statistics>
+      <Statistics_db-num>{nhits}</Statistics_db-num>
+      <Statistics_db-len>{dblen}</Statistics_db-len>
+      <Statistics_hsp-len>0</Statistics_hsp-len>
+      <Statistics_eff-space>0</Statistics_eff-space>
+      <Statistics_kappa>0.041</Statistics_kappa>
+      <Statistics_lambda>0.267</Statistics_lambda>
+      <Statistics_entropy>0.14</Statistics_entropy>
+    </Statistics>
+  </Iteration_stat>
+</Iteration>
+'''
+ITERATION_END_ELEMENTS = 9
+
+FOOTER = '''</BlastOutput_iterations>
+</BlastOutput>
+'''
+
+# Metrics compared by --compare, True if larger is better
+METRICS = (
+    ('seconds', False),
+    ('elements_per_sec', True),
+    ('rows_per_sec', True),
+    ('peak_rss_kib', False),
+    ('db_bytes', False))
+
+
+# ==================
+# EXPORTED FUNCTIONS
+# ==================
+
+def parse(parent, *args, **kwargs):
+    parser = parent.add_parser(
+        'bench',
+        help="Time 'blast' on synthetic BLAST XML (offline, needs an empty database)",
+        parents=args)
+    parser.add_argument(
+        '--queries',
+        metavar="INT",
+        help="Queries per report file (default 1000)",
+        type=int,
+        default=1000)
+    parser.add_argument(
+        '--hits',
+        metavar="INT",
+        help="Hits per query (default 20)",
+        type=int,
+        default=20)
+    parser.add_argument(
+        '--hsps',
+        metavar="INT",
+        help="Hsps per hit (default 2)",
+        type=int,
+        default=2)
+    parser.add_argument(
+        '--length',
+        metavar="INT",
+        help="Alignment length (default 150)",
+        type=int,
+        default=150)
+    parser.add_argument(
+        '--files',
+        metavar="INT",
+        help="Number of report files, each against its own database (default 1)",
+        type=int,
+        default=1)
+    parser.add_argument(
+        '--seed',
+        metavar="INT",
+        help="Random seed (default 1)",
+        type=int,
+        default=1)
+    parser.add_argument(
+        '--blast-args',
+        metavar="ARGS",
+        help="Options passed on to 'blast', e.g. '--bulk -j 4' (--no-meta is always added)",
+        default='')
+    parser.add_argument(
+        '--xml-dir',
+        metavar="DIR",
+        help="Write (and keep) the synthetic reports here (default a temporary directory)")
+    parser.add_argument(
+        '-o', '--output',
+        metavar="FILE",
+        help="Write the results as JSON to FILE (default stdout)")
+    parser.add_argument(
+        '--compare',
+        metavar="FILE",
+        help="Print the change from the results stored in FILE")
+    parser.set_defaults(func=bench)
+
+def bench(args, cur):
+    if(misc.table_exists('blastreport', cur)):
+        print("{} already holds BLAST results, bench needs an empty database".format(
+              args.sqldb), file=sys.stderr)
+        sys.exit(1)
+
+    xml_dir = args.xml_dir or tempfile.mkdtemp(prefix='blastdbm-bench-')
+    os.makedirs(xml_dir, exist_ok=True)
+    filenames = []
+    nelem = 0
+    for i in range(args.files):
+        filename = os.path.join(xml_dir, 'synthetic_{}.xml'.format(i))
+        with open(filename, 'w') as f:
+            nelem += write_blast_xml(f, queries=args.queries, hits=args.hits,
+                                     hsps=args.hsps, length=args.length,
+                                     seed=args.seed + i,
+                                     db='Synthetic_{}.faa'.format(i))
+        filenames.append(filename)
+    xml_bytes = sum(os.path.getsize(x) for x in filenames)
+
+    bargs = _blast_args(args, filenames)
+    start = time.perf_counter()
+    blastin.parse_blast_xml(bargs, cur)
+    cur.connection.commit()
+    seconds = time.perf_counter() - start
+
+    if(not args.xml_dir):
+        for filename in filenames:
+            os.remove(filename)
+        os.rmdir(xml_dir)
+
+    nrows = misc.fetch("select count(*) from blastreport", cur)[0][0]
+    results = {
+        'revision'         : _revision(),
+        'python'           : platform.python_version(),
+        'sqlite'           : sql.sqlite_version,
+        'date'             : time.strftime('%Y-%m-%d %H:%M:%S'),
+        'workload'         : {'files'   : args.files,
+                              'queries' : args.queries,
+                              'hits'    : args.hits,
+                              'hsps'    : args.hsps,
+                              'length'  : args.length,
+                              'seed'    : args.seed},
+        'blast_args'       : args.blast_args,
+        'xml_bytes'        : xml_bytes,
+        'elements'         : nelem,
+        'rows'             : nrows,
+        'seconds'          : round(seconds, 4),
+        'elements_per_sec' : round(nelem / seconds),
+        'rows_per_sec'     : round(nrows / seconds),
+        'peak_rss_kib'     : max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                                 resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss),
+        'db_bytes'         : _db_size(cur)
+    }
+
+    if(args.output):
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+            f.write('\n')
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+
+    if(args.compare):
+        with open(args.compare) as f:
+            _compare(json.load(f), results)
+
+def write_blast_xml(fh, queries=1000, hits=20, hsps=2, length=150, seed=1,
+                    db='Synthetic.faa'):
+    '''
+    Writes a synthetic BLAST XML (-outfmt 5) report to fh. Every seventh
+    query has no hits. Returns the number of XML elements written.
+    '''
+    r = random.Random(seed)
+    w = fh.write
+    w(HEADER.format(db=db, first=_query_def(0), first_len=length + 50))
+    nelem = HEADER_ELEMENTS
+    for q in range(queries):
+        w(ITERATION.format(num=q + 1, qdef=_query_def(q), qlen=length + 50))
+        nhits = 0 if q % 7 == 6 else hits
+        for h in range(nhits):
+            w(HIT.format(num=h + 1, id=r.randrange(10**6), len=length + r.randrange(500)))
+            for s in range(hsps):
+                bits = r.uniform(20, 1000)
+                qseq = ''.join(r.choices(AMINO_ACIDS, k=length))
+                hseq = ''.join(r.choice((c, c, c, 'A')) for c in qseq)
+                midline = ''.join(a if a == b else ' ' for a, b in zip(qseq, hseq))
+                w(HSP.format(num=s + 1, bits=bits, score=int(bits * 2),
+                             evalue=10 ** r.uniform(-180, 1), length=length,
+                             identity=sum(c != ' ' for c in midline),
+                             qseq=qseq, hseq=hseq, midline=midline))
+            w(HIT_END)
+        w(ITERATION_END.format(nhits=nhits, dblen=nhits * 500))
+        nelem += ITERATION_ELEMENTS + ITERATION_END_ELEMENTS + \
+                 nhits * (HIT_ELEMENTS + hsps * HSP_ELEMENTS)
+    w(FOOTER)
+    return(nelem)
+
+
+# =================
+# UTILITY FUNCTIONS
+# =================
+
+def _query_def(q):
+    return('AT{}G{:05d} locus|AT{}G{:05d} gi|{} gb|SYN{:06d}'.format(
+           q % 5 + 1, q, q % 5 + 1, q, 10**6 + q, q))
+
+def _blast_args(args, filenames):
+    '''
+    Builds the 'blast' namespace through its own parser, so the defaults are
+    those of a real run
+    '''
+    _input = argparse.ArgumentParser(add_help=False)
+    _input.add_argument('-i', '--input', nargs='*')
+    _sqldb = argparse.ArgumentParser(add_help=False)
+    _sqldb.add_argument('-q', '--sqldb')
+    parser = argparse.ArgumentParser(prog='bench')
+    blastin.parse(parser.add_subparsers(), _input, _sqldb)
+    argv = ['blast', '-q', args.sqldb, '--no-meta', '-i'] + filenames
+    return(parser.parse_args(argv + shlex.split(args.blast_args)))
+
+def _db_size(cur):
+    page_count = misc.fetch('PRAGMA page_count', cur)[0][0]
+    page_size = misc.fetch('PRAGMA page_size', cur)[0][0]
+    return(page_count * page_size)
+
+def _revision():
+    try:
+        out = subprocess.run(['git', 'describe', '--always', '--dirty'],
+                             cwd=os.path.dirname(os.path.abspath(__file__)),
+                             capture_output=True, text=True)
+    except OSError:
+        return(None)
+    return(out.stdout.strip() or None)
+
+def _compare(old, new, fh=sys.stderr):
+    if(old.get('workload') != new['workload'] or
+       old.get('blast_args') != new['blast_args']):
+        print("Warning: the stored results are for a different workload or options",
+              file=fh)
+    print("{:<18} {:>14} {:>14} {:>8}".format(
+          'metric', old.get('revision') or 'old', new['revision'] or 'new', 'change'),
+          file=fh)
+    for metric, larger_is_better in METRICS:
+        a, b = old.get(metric), new[metric]
+        if(not a):
+            continue
+        change = (b - a) / a * 100
+        better = (change > 0) == larger_is_better
+        print("{:<18} {:>14} {:>14} {:>+7.1f}%{}".format(
+              metric, a, b, change, '' if abs(change) < 5 or better else '  <-- worse'),
+              file=fh)
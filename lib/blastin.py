@@ -1,17 +1,45 @@
 #! /usr/bin/python3
 
 import argparse
+import collections
+import functools
+import itertools
+import multiprocessing
 import os
 import re
 import sqlite3 as sql
 import sys
+import tempfile
 import xml.etree.cElementTree as et
+import xml.parsers.expat as expat
 import traceback
 
+import lib.blasttab as blasttab
+import lib.compression as compression
 import lib.initialize as initialize
+import lib.manifest as manifest
+import lib.maxhsp as maxhsp
+import lib.phylostrata as phylostrata
 import lib.sqlite_interface as misc
 import lib.meta as meta
+import lib.shard as shard
+import lib.writer as writer
 
+# =========
+# CONSTANTS
+# =========
+
+# Elements whose children can be dropped from the tree once they end
+CLEARED_TAGS = frozenset(('Hsp', 'Hit', 'Iteration'))
+
+QUERY_SEQID = re.compile(r'(\S+).*')
+
+# Rows per transaction in --bulk mode (--batch-bytes still applies)
+BULK_BATCH_ROWS = 200000
+
+# Files parsed ahead of the writer per worker with -j, bounding the spools
+# on disk to about this many files per worker
+FILES_IN_FLIGHT = 2
 
 # ==================
 # EXPORTED FUNCTIONS
@@ -20,7 +48,7 @@ import lib.meta as meta
 def parse(parent, *args, **kwargs):
     parser = parent.add_parser(
         'blast',
-        help="Read BLAST XML report into SQL database",
+        help="Read BLAST XML (or tabular) report into SQL database",
         parents=args)
     parser.add_argument(
         '-c', '--collection',
@@ -34,6 +62,21 @@ def parse(parent, *args, **kwargs):
         '-s', '--small',
         help="Reduce database size by not writing alignment sequences",
         action=('store_true'), default=False)
+    parser.add_argument(
+        '--pack-alignments',
+        help="Store alignment sequences compressed in the HspAlignment table "
+             "(read them through the BlastAlignment view)",
+        action='store_true', default=False)
+    parser.add_argument(
+        '--normalized',
+        help="Create the database with separate run, query, hit and hsp tables "
+             "behind a BlastReport view (smaller, faster scans)",
+        action='store_true', default=False)
+    parser.add_argument(
+        '--shard-by',
+        help="Create the database as a catalog of shard files, one per BLAST "
+             "database or per collection (-c)",
+        choices=shard.SHARD_BY)
     parser.add_argument(
         '-x', '--max-hits',
         metavar="INT",
@@ -41,47 +84,407 @@ def parse(parent, *args, **kwargs):
         type=int,
         default=500
     )
+    parser.add_argument(
+        '--max-hsps',
+        metavar="INT",
+        help="Maximum number of hsps to store per hit",
+        type=int)
+    parser.add_argument(
+        '--max-evalue',
+        metavar="FLOAT",
+        help="Do not store hsps with a higher e-value",
+        type=float)
+    parser.add_argument(
+        '--min-bitscore',
+        metavar="FLOAT",
+        help="Do not store hsps with a lower bit score",
+        type=float)
+    parser.add_argument(
+        '-j', '--jobs',
+        metavar="INT",
+        help="Number of worker processes parsing input files (default 1)",
+        type=int,
+        default=1
+    )
+    parser.add_argument(
+        '--batch-rows',
+        metavar="INT",
+        help="Write and commit after buffering this many rows "
+             "(default {}, {} with --bulk)".format(writer.BATCH_ROWS, BULK_BATCH_ROWS),
+        type=int
+    )
+    parser.add_argument(
+        '--batch-bytes',
+        metavar="INT",
+        help="Write and commit after buffering this many bytes of field text (default {})".format(
+             writer.BATCH_BYTES),
+        type=int,
+        default=writer.BATCH_BYTES
+    )
+    parser.add_argument(
+        '--parser',
+        help="XML parser: 'iterparse' (ElementTree) or 'expat' (callbacks, no tree)",
+        choices=['iterparse', 'expat'],
+        default='iterparse')
+    parser.add_argument(
+        '--format',
+        help="Report format: 'xml' (-outfmt 5) or 'tab' (-outfmt 6 or 7)",
+        choices=['xml', 'tab'],
+        default='xml')
+    parser.add_argument(
+        '--reload',
+        help="Reload input files even if the manifest shows them unchanged",
+        action='store_true', default=False)
+    parser.add_argument(
+        '--bulk',
+        help="Fast load: no fsyncs, large transactions and BlastReport indices "
+             "rebuilt (then ANALYZE) at the end. Rerun after a crash.",
+        action='store_true', default=False)
+    parser.add_argument(
+        '--no-meta',
+        help="Do not look up taxonomy for new databases (run 'update' later)",
+        dest='meta',
+        action='store_false', default=True)
+    parser.add_argument(
+        '--report',
+        help="Print row counts and memory high-water marks when done",
+        action='store_true', default=False)
+    tab = parser.add_argument_group('tabular input (--format tab)')
+    tab.add_argument(
+        '--outfmt',
+        metavar="SPEC",
+        help="The -outfmt given to BLAST, e.g. '6 qseqid sseqid evalue bitscore' "
+             "(default '6', outfmt 7 reports carry their own field list)")
+    tab.add_argument(
+        '--blast-db',
+        metavar="DB",
+        help="BLAST database searched (default from '# Database:' lines)")
+    tab.add_argument(
+        '--program',
+        metavar="PROG",
+        help="BLAST program (default from the outfmt 7 header, else blastp)",
+        default='blastp')
+    tab.add_argument(
+        '--blast-version',
+        metavar="VER",
+        help="BLAST version string (default from the outfmt 7 header)")
+    tab.add_argument(
+        '--query-lengths',
+        metavar="FILE",
+        help="Whitespace delimited file of query seqids and lengths, "
+             "used when qlen is not among the fields")
+    tab.add_argument(
+        '--param',
+        metavar="KEY=VAL",
+        help="Search parameter to store, e.g. matrix=BLOSUM62 expect=1e-5",
+        nargs='+')
     parser.set_defaults(func=parse_blast_xml)
 
 def parse_blast_xml(args, cur):
-    if args.input:
-        for f in args.input:
-            con = et.iterparse(f, events=('end', 'start'))
-            _parse_blast_xml(args, cur, con)
+    if(args.batch_rows is None):
+        args.batch_rows = BULK_BATCH_ROWS if args.bulk else writer.BATCH_ROWS
+    shards = _init_shards(args, cur)
+    if(shards is None):
+        normalized = _init_tables(args, cur)
+        _prepare_report_db(args, cur)
+    else:
+        # The catalog holds everything but the report tables
+        normalized = shards.normalized
+        shards.setup = functools.partial(_init_shard, args, normalized)
+        if(not misc.table_exists('blastdatabase', cur)):
+            initialize.init_blastdatabase(cur, verbose=False)
+        if(args.bulk):
+            misc.bulk_mode(cur, True)
+    rw = writer.RowWriter(cur, max_rows=args.batch_rows, max_bytes=args.batch_bytes,
+                          pack=args.pack_alignments, normalized=normalized,
+                          shards=shards)
+    if(not args.input or '-' in args.input):
+        # Not in the manifest, the materialized tables are told of each
+        # batch of queries as it is written
+        rw.notify = _invalidate_keys
+        for filename in (args.input or ['-']):
+            with compression.open_input(filename) as f:
+                _parse_blast_xml(args, cur, f, rw)
+        rw.notify = None
     else:
-        con = et.iterparse(sys.stdin, events=('end', 'start'))
-        _parse_blast_xml(args, cur, con)
+        states = manifest.pending(args.input, cur, reload=args.reload)
+        nskip = len(args.input) - len(states)
+        if(args.jobs > 1 and states):
+            nskip += _parse_blast_xml_parallel(args, cur, rw, states)
+        else:
+            for state in states:
+                state.hash = manifest.file_hash(state.path)
+                if(state.unchanged()):
+                    manifest.touch(state, cur)
+                    nskip += 1
+                    continue
+                manifest.forget(state.path, cur, shards)
+                rw.source = state.path
+                with compression.open_input(state.path) as f:
+                    bdat = _parse_blast_xml(args, cur, f, rw)
+                manifest.record(state, bdat.databases, cur)
+                misc.checkpoint(cur)
+                rw.source = None
+        if(nskip):
+            print("Skipped {} unchanged file(s)".format(nskip), file=sys.stderr)
+    if(shards is None):
+        _finish_report_db(args, cur)
+    else:
+        for key, scur in shards.curs.items():
+            _finish_report_db(args, scur)
+            misc.checkpoint(scur, 'TRUNCATE')
+            scur.connection.close()
+        if(args.bulk):
+            misc.bulk_mode(cur, False)
+    if args.meta:
+        # Only databases and taxa not seen before are looked up
+        meta.update_dbinfo(cur, verbose=True)
+        meta.update_mrca(cur, verbose=True, only_new=True)
+    if(shards is None):
+        # Best HSPs of the pairs just loaded, for query maxattr
+        maxhsp.refresh(cur)
+    # Leave a short WAL (unless readers still hold older snapshots)
+    misc.checkpoint(cur, 'TRUNCATE')
+    if args.report:
+        rw.report()
 
-def _parse_blast_xml(args, cur, con):
-    # Initialize tables as necessary
-    if(not misc.table_exists('blastreport', cur)):
-        initialize.init_blastreport(cur, verbose=False)
+def _invalidate_keys(keys, cur):
+    phylostrata.invalidate_keys(keys, cur)
+    maxhsp.invalidate_keys(keys, cur)
+
+def _parse_blast_xml(args, cur, f, rw):
+    bdat = _read_report(args, f, rw)
+    rw.flush()
+    _add_databases(bdat.databases, cur)
+    return(bdat)
+
+def _parse_blast_xml_parallel(args, cur, rw, states):
+    '''
+    Parses each input file in a worker process. The workers only build rows
+    (spooling them to a temporary file in batches), this (the parent) process
+    owns the database and writes each file's rows in input order, so the
+    result is identical to a serial load. Returns the number of files whose
+    content turned out to be unchanged.
+    '''
+    nskip = 0
+    wargs = _worker_args(args)
+    njobs = min(args.jobs, len(states))
+    # The spools live in a directory of this run, removed (with whatever a
+    # failed worker or an interrupted load left in it) when the run ends
+    with tempfile.TemporaryDirectory(prefix='blastdbm-') as spool_dir, \
+         multiprocessing.Pool(njobs) as pool:
+        jobs = iter([(wargs, spool_dir, state.path, state.known_hash)
+                     for state in states])
+        # A sliding window of files handed to the workers, refilled as the
+        # writer takes each one in input order
+        window = collections.deque(
+            pool.apply_async(_parse_blast_xml_worker, (job, ))
+            for job in itertools.islice(jobs, FILES_IN_FLIGHT * njobs))
+        for state in states:
+            databases, spool, digest = window.popleft().get()
+            for job in itertools.islice(jobs, 1):
+                window.append(pool.apply_async(_parse_blast_xml_worker, (job, )))
+            state.hash = digest
+            if(state.unchanged()):
+                manifest.touch(state, cur)
+                nskip += 1
+                continue
+            manifest.forget(state.path, cur, rw.shards)
+            rw.source = state.path
+            # The spool is deleted once read
+            rw.replay(spool)
+            rw.flush()
+            _add_databases(databases, cur)
+            manifest.record(state, databases, cur)
+            misc.checkpoint(cur)
+            rw.source = None
+    return(nskip)
+
+def _parse_blast_xml_worker(job):
+    args, spool_dir, filename, known_hash = job
+    digest = manifest.file_hash(filename)
+    if(digest == known_hash):
+        return((None, None, digest))
+    sw = writer.SpoolWriter(directory=spool_dir, max_rows=args.batch_rows,
+                            max_bytes=args.batch_bytes, pack=args.pack_alignments)
+    with compression.open_input(filename) as f:
+        bdat = _read_report(args, f, sw)
+    return((bdat.databases, sw.close(), digest))
+
+def _worker_args(args):
+    '''
+    Copies the options the readers need into a picklable namespace (the full
+    namespace holds the subcommand function)
+    '''
+    fields = ('collection', 'db_desc', 'small', 'pack_alignments', 'max_hits',
+              'max_hsps', 'max_evalue', 'min_bitscore', 'parser',
+              'batch_rows', 'batch_bytes', 'format', 'outfmt', 'blast_db',
+              'program', 'blast_version', 'query_lengths', 'param')
+    return(argparse.Namespace(**{k: getattr(args, k) for k in fields}))
+
+def _init_tables(args, cur):
+    '''
+    Initializes tables as necessary. Returns True if the database uses the
+    normalized layout.
+    '''
+    normalized = _init_report_tables(args, args.normalized, cur)
     if(not misc.table_exists('blastdatabase', cur)):
         initialize.init_blastdatabase(cur, verbose=False)
+    return(normalized)
 
-    bdat = Blastdat(cur, args)
-    for event, elem in con:
-        if(event == 'start'): continue
-        if(elem.tag == 'Hsp'):
-            bdat.add_partial_row()
-            bdat.clear_hsp()
-        elif(elem.tag == 'Hit'):
-            bdat.clear_hit()
-        elif(elem.tag == 'Iteration'):
-            if(not bdat.has_hits()):
-                bdat.add_partial_row()
-            bdat.clear_iter()
-            elem.clear()
-        elif('BlastOutput_db' in elem.tag):
-            base = os.path.basename(elem.text)
-            if(not misc.entry_exists('blastdatabase', 'database', base, cur)):
-                misc.insert({'database': base}, 'blastdatabase', cur)
-            bdat.add(elem.tag, base)
+def _init_report_tables(args, normalized_layout, cur):
+    normalized = misc.table_exists('blastquery', cur)
+    if(not misc.table_exists('blastreport', cur)):
+        if(normalized_layout):
+            small = args.small or args.pack_alignments
+            initialize.init_normalized(cur, hsp_without_rowid=small, verbose=False)
+            normalized = True
         else:
-            bdat.add(elem.tag, elem.text)
-    bdat.write_rows_to_sqldb()
-    meta.update_dbinfo(cur, verbose=True)
-    meta.update_mrca(cur, verbose=True)
+            initialize.init_blastreport(cur, verbose=False)
+    elif(normalized_layout and not normalized):
+        print("{} already holds a flat BlastReport table, --normalized only "
+              "applies to new databases".format(args.sqldb), file=sys.stderr)
+        sys.exit(1)
+    return(normalized)
+
+def _init_shards(args, cur):
+    '''
+    Returns the ShardSet of a sharded (catalog) database, creating the
+    catalog if --shard-by is given for a new database, or None
+    '''
+    if(shard.is_sharded(cur)):
+        shards = shard.ShardSet(cur, args.sqldb)
+        if(args.shard_by and args.shard_by != shards.shard_by):
+            print("{} is sharded by {}, not {}".format(
+                  args.sqldb, shards.shard_by, args.shard_by), file=sys.stderr)
+            sys.exit(1)
+    elif(args.shard_by):
+        if(misc.table_exists('blastreport', cur)):
+            print("{} already holds unsharded BLAST results, --shard-by only "
+                  "applies to new databases".format(args.sqldb), file=sys.stderr)
+            sys.exit(1)
+        shard.init_shards(cur, args.shard_by, args.normalized)
+        shards = shard.ShardSet(cur, args.sqldb)
+    else:
+        return(None)
+    if(shards.shard_by == 'collection'):
+        if(not args.collection):
+            print("{} is sharded by collection, give one with -c".format(args.sqldb),
+                  file=sys.stderr)
+            sys.exit(1)
+        shards.collection = args.collection
+    return(shards)
+
+def _init_shard(args, normalized, cur):
+    _init_report_tables(args, normalized, cur)
+    _prepare_report_db(args, cur)
+
+def _prepare_report_db(args, cur):
+    '''
+    Readies the report tables of a database (or shard) for loading
+    '''
+    if(args.format == 'tab'):
+        _check_nullable(args, cur)
+    if(args.pack_alignments and not misc.table_exists('hspalignment', cur)):
+        initialize.init_hspalignment(cur, verbose=False)
+    if(args.bulk):
+        misc.bulk_mode(cur, True)
+        for table in ('BlastReport', 'BlastQuery', 'BlastHit', 'BlastHsp'):
+            initialize.drop_indices(table, cur)
+    else:
+        # Rebuild indices left dropped by an interrupted bulk load
+        initialize.restore_indices(cur, verbose=True)
+
+def _check_nullable(args, cur):
+    '''
+    Tabular reports leave the search parameters (and maybe the query
+    lengths) NULL, which databases made before they could be are not
+    allowed to hold
+    '''
+    table = 'blastrun' if misc.table_exists('blastrun', cur) else 'blastreport'
+    columns = misc.fetch("PRAGMA table_info({})".format(table), cur)
+    if(any(x[1].lower() == 'parameters_expect' and x[3] for x in columns)):
+        print("{} requires search parameters and query lengths, load tabular "
+              "reports into a new database".format(args.sqldb), file=sys.stderr)
+        sys.exit(1)
+
+def _finish_report_db(args, cur):
+    if(args.bulk):
+        initialize.restore_indices(cur, verbose=True)
+        misc.execute('ANALYZE', cur)
+        misc.bulk_mode(cur, False)
+
+def _add_databases(databases, cur):
+    for base in databases:
+        if(not misc.entry_exists('blastdatabase', 'database', base, cur)):
+            misc.insert({'database': base}, 'blastdatabase', cur)
+            meta.touch_taxonomy(cur)
+
+def _read_report(args, f, rw):
+    '''
+    Builds the rows of one BLAST report and hands them to the writer rw.
+    Returns the reader, which lists the databases seen.
+    '''
+    if(args.format == 'tab'):
+        lengths = None
+        if(args.query_lengths):
+            lengths = blasttab.read_query_lengths(args.query_lengths)
+        btab = blasttab.Blasttab(args, rw, lengths)
+        btab.read(f)
+        return(btab)
+    else:
+        return(_read_blast_xml(args, f, rw))
+
+def _read_blast_xml(args, f, rw):
+    '''
+    Builds the rows of one BLAST XML report and hands them to the writer rw
+    '''
+    bdat = Blastdat(args, rw)
+    if(args.parser == 'expat'):
+        _read_expat(bdat, f)
+    else:
+        _read_iterparse(bdat, f)
+    return(bdat)
+
+def _read_iterparse(bdat, f):
+    end = bdat.end
+    for event, elem in et.iterparse(f, events=('end',)):
+        tag = elem.tag
+        end(tag, elem.text)
+        # Free the children of finished records
+        if(tag in CLEARED_TAGS):
+            elem.clear()
+
+def _read_expat(bdat, f, chunksize=2**20):
+    '''
+    Feeds the report to an expat parser whose callbacks go straight to the
+    Blastdat handlers, no element tree is built
+    '''
+    text = []
+    handlers = bdat.handlers
+
+    def start_element(tag, attrs):
+        text.clear()
+
+    def end_element(tag):
+        try:
+            handler = handlers[tag]
+        except KeyError:
+            handler = handlers[tag] = bdat._handler(tag)
+        handler(''.join(text) if text else None)
+        text.clear()
+
+    parser = expat.ParserCreate()
+    parser.buffer_text = True
+    parser.StartElementHandler = start_element
+    parser.EndElementHandler = end_element
+    parser.CharacterDataHandler = text.append
+    while(True):
+        chunk = f.read(chunksize)
+        if(not chunk):
+            break
+        parser.Parse(chunk, False)
+    parser.Parse('', True)
 
 def _parse_fasta_header(header):
     dic = {}
@@ -97,19 +500,81 @@ def _parse_fasta_header(header):
 
 
 class Blastdat:
-    def __init__(self, cur, args):
-        self.cur = cur
+    def __init__(self, args, writer):
         self.args = args
+        self.writer = writer
         self.dat = {'root':{}, 'iter':{}, 'stat':{}, 'hit':{}, 'hsp':{}}
         self.dat['root']['collection'] = args.collection
         self.dat['root']['db_desc'] = args.db_desc
         self.iter_dicts = []
-        self.row_by_col = {}
+        self.databases = []
+        self.handlers = {}
+        self.setters = {}
+        self.cols = {}
+        self.skip_hit = False
+        self.prune_hsps = (args.max_hsps is not None or
+                           args.max_evalue is not None or
+                           args.min_bitscore is not None)
+
+    def end(self, tag, text):
+        '''
+        Handles the end of one element. The handler for each tag name is
+        worked out the first time the tag is seen.
+        '''
+        try:
+            handler = self.handlers[tag]
+        except KeyError:
+            handler = self.handlers[tag] = self._handler(tag)
+        handler(text)
+
+    def _handler(self, tag):
+        if(tag == 'Hsp'):
+            return(self._end_hsp)
+        elif(tag == 'Hit'):
+            return(self._end_hit)
+        elif(tag == 'Iteration'):
+            return(self._end_iter)
+        elif('BlastOutput_db' in tag):
+            return(functools.partial(self._end_db, tag))
+        else:
+            return(self._field_setter(tag))
+
+    def _end_hsp(self, text):
+        if(not self.skip_hit and (not self.prune_hsps or self._keep_hsp())):
+            self.add_partial_row()
+        self.clear_hsp()
 
-    def write_rows_to_sqldb(self):
-        for col in self.row_by_col.keys():
-            misc.insertmany(col, self.row_by_col[col], 'BlastReport',
-                            self.cur, replace=True)
+    def _keep_hsp(self):
+        '''
+        Checks the current hsp against --max-hsps, --max-evalue and
+        --min-bitscore
+        '''
+        args = self.args
+        hsp = self.dat['hsp']
+        try:
+            if(args.max_hsps is not None and int(hsp['Hsp_num']) > args.max_hsps):
+                return False
+            if(args.max_evalue is not None and float(hsp['Hsp_evalue']) > args.max_evalue):
+                return False
+            if(args.min_bitscore is not None and
+               float(hsp['Hsp_bit_score']) < args.min_bitscore):
+                return False
+        except KeyError:
+            pass
+        return True
+
+    def _end_hit(self, text):
+        self.clear_hit()
+
+    def _end_iter(self, text):
+        if(not self.has_hits()):
+            self.add_partial_row()
+        self.clear_iter()
+
+    def _end_db(self, tag, text):
+        base = os.path.basename(text)
+        self.databases.append(base)
+        self.add(tag, base)
 
     def has_hits(self):
         try:
@@ -121,25 +586,26 @@ class Blastdat:
 
     def add_partial_row(self):
         table = {}
-        for key in self.dat.keys():
-            for subkey in self.dat[key].keys():
-                table[subkey] = self.dat[key][subkey]
+        for group in self.dat.values():
+            table.update(group)
         self.iter_dicts.append(table)
 
     def _add_rows(self):
         if(not self.iter_dicts):
             self.add_partial_row()
         else:
+            # Hits beyond --max-hits were never added (see _set_hit_num)
             for d in self.iter_dicts:
-                if(int(d['Hit_num']) <= self.args.max_hits):
-                    for key, val in self.dat['stat'].items():
-                        d[key] = val
-                    col = tuple(sorted(d.keys()))
-                    row = tuple(map(d.get, col))
-                    try:
-                        self.row_by_col[col].append(row)
-                    except:
-                        self.row_by_col[col] = [row]
+                d.update(self.dat['stat'])
+                # Rows with the same fields in the same order share a
+                # sorted column tuple
+                order = tuple(d)
+                try:
+                    col = self.cols[order]
+                except KeyError:
+                    col = self.cols[order] = tuple(sorted(order))
+                row = tuple(map(d.get, col))
+                self.writer.add(col, row)
         self.iter_dicts = []
 
     def clear_iter(self):
@@ -157,6 +623,7 @@ class Blastdat:
         Clears the current hit and all children hsps from memory
         '''
         self.dat['hit'] = {}
+        self.skip_hit = False
         self.clear_hsp()
 
     def clear_hsp(self):
@@ -169,23 +636,59 @@ class Blastdat:
         '''
         Input: One tag and its text (possibly None)
         '''
-        tag = re.sub('-', '_', tag)
-        if(text is None or text.isspace()): pass
-        elif('Hsp_' in tag):
+        try:
+            setter = self.setters[tag]
+        except KeyError:
+            setter = self.setters[tag] = self._field_setter(tag)
+        setter(text)
+
+    def _field_setter(self, tag):
+        '''
+        Returns a function that stores the text of a leaf element under its
+        column name in the right group, or ignores it
+        '''
+        tag = tag.replace('-', '_')
+        group = None
+        if('Hsp_' in tag):
             if(tag in ('Hsp_qseq', 'Hsp_hseq', 'Hsp_midline') and self.args.small):
                 pass
             else:
-                self.dat['hsp'][tag] = text
+                group = 'hsp'
         elif('Hit_' in tag):
-            self.dat['hit'][tag] = text
+            if(tag == 'Hit_num'):
+                return(self._set_hit_num)
+            group = 'hit'
         elif('Iteration_' in tag):
             if(tag == 'Iteration_query_def'):
-                self.dat['iter']['query_seqid'] = re.sub('(\S+).*', '\\1', text)
-            self.dat['iter'][tag] = text
+                return(self._set_query_def)
+            group = 'iter'
         elif('Statistics_' in tag):
-            self.dat['stat'][tag] = text
+            group = 'stat'
         elif('BlastOutput_' in tag or 'Parameters_' in tag):
             if('reference' in tag or 'query' in tag):
                 pass
             else:
-                self.dat['root'][tag] = text
+                group = 'root'
+        if(group is None):
+            return(_skip)
+        dat = self.dat
+
+        def setter(text):
+            if(text is None or text.isspace()): return
+            dat[group][tag] = text
+        return(setter)
+
+    def _set_hit_num(self, text):
+        if(text is None or text.isspace()): return
+        self.dat['hit']['Hit_num'] = text
+        # Hit_num precedes the hsps, so hits past the cutoff are never built
+        self.skip_hit = int(text) > self.args.max_hits
+
+    def _set_query_def(self, text):
+        if(text is None or text.isspace()): return
+        self.dat['iter']['query_seqid'] = QUERY_SEQID.sub(r'\1', text)
+        self.dat['iter']['Iteration_query_def'] = text
+
+
+def _skip(text):
+    pass
@@ -0,0 +1,277 @@
+#! /usr/bin/python3
+
+import os
+import re
+import sys
+
+# =========
+# CONSTANTS
+# =========
+
+# Fields of a bare '-outfmt 6' or '-outfmt 7'
+DEFAULT_FIELDS = ('qseqid', 'sseqid', 'pident', 'length', 'mismatch',
+                  'gapopen', 'qstart', 'qend', 'sstart', 'send', 'evalue',
+                  'bitscore')
+
+# outfmt field name -> BlastReport column (fields not listed are ignored)
+FIELD2COLUMN = {
+    'qseqid'   : 'Query_seqid',
+    'qlen'     : 'Iteration_query_len',
+    'sseqid'   : 'Hit_id',
+    'sacc'     : 'Hit_accession',
+    'slen'     : 'Hit_len',
+    'stitle'   : 'Hit_def',
+    'length'   : 'Hsp_align_len',
+    'nident'   : 'Hsp_identity',
+    'positive' : 'Hsp_positive',
+    'gaps'     : 'Hsp_gaps',
+    'qstart'   : 'Hsp_query_from',
+    'qend'     : 'Hsp_query_to',
+    'sstart'   : 'Hsp_hit_from',
+    'send'     : 'Hsp_hit_to',
+    'qframe'   : 'Hsp_query_frame',
+    'sframe'   : 'Hsp_hit_frame',
+    'evalue'   : 'Hsp_evalue',
+    'bitscore' : 'Hsp_bit_score',
+    'score'    : 'Hsp_score',
+    'qseq'     : 'Hsp_qseq',
+    'sseq'     : 'Hsp_hseq'
+}
+
+# Names used on the '# Fields:' line of outfmt 7 -> outfmt field name
+LONG2FIELD = {
+    'query id'         : 'qseqid',
+    'query gi'         : 'qgi',
+    'query acc.'       : 'qacc',
+    'query acc.ver'    : 'qaccver',
+    'query length'     : 'qlen',
+    'subject id'       : 'sseqid',
+    'subject ids'      : 'sallseqid',
+    'subject gi'       : 'sgi',
+    'subject gis'      : 'sallgi',
+    'subject acc.'     : 'sacc',
+    'subject acc.ver'  : 'saccver',
+    'subject accs.'    : 'sallacc',
+    'subject length'   : 'slen',
+    'q. start'         : 'qstart',
+    'q. end'           : 'qend',
+    's. start'         : 'sstart',
+    's. end'           : 'send',
+    'query seq'        : 'qseq',
+    'subject seq'      : 'sseq',
+    'evalue'           : 'evalue',
+    'bit score'        : 'bitscore',
+    'score'            : 'score',
+    'alignment length' : 'length',
+    '% identity'       : 'pident',
+    'identical'        : 'nident',
+    'mismatches'       : 'mismatch',
+    'positives'        : 'positive',
+    'gap opens'        : 'gapopen',
+    'gaps'             : 'gaps',
+    '% positives'      : 'ppos',
+    'query/sbjct frames' : 'frames',
+    'query frame'      : 'qframe',
+    'sbjct frame'      : 'sframe',
+    'subject title'    : 'stitle',
+    'subject titles'   : 'salltitles',
+    'subject strand'   : 'sstrand',
+    '% query coverage per subject' : 'qcovs',
+    '% query coverage per hsp'     : 'qcovhsp'
+}
+
+# Search parameters tabular output does not carry, stored as NULL unless
+# given with --param
+PARAMETERS = {
+    'Parameters_matrix'     : None,
+    'Parameters_expect'     : None,
+    'Parameters_gap_open'   : None,
+    'Parameters_gap_extend' : None,
+    'Parameters_filter'     : None
+}
+
+
+# ==================
+# EXPORTED FUNCTIONS
+# ==================
+
+def parse_outfmt(spec):
+    '''
+    Reads an -outfmt string such as "6 qseqid sseqid evalue" and returns the
+    tuple of field names (the default fields if only the number is given)
+    '''
+    words = spec.split() if spec else ['6']
+    if(words[0] not in ('6', '7')):
+        print("Only tabular output (-outfmt 6 or 7) can be read, got '{}'".format(spec),
+              file=sys.stderr)
+        sys.exit(1)
+    fields = tuple(words[1:])
+    if('std' in fields):
+        i = fields.index('std')
+        fields = fields[:i] + DEFAULT_FIELDS + fields[i+1:]
+    return(fields or DEFAULT_FIELDS)
+
+def read_query_lengths(filename):
+    '''
+    Reads a two-column (seqid, length) whitespace delimited file
+    '''
+    lengths = {}
+    with open(filename) as f:
+        for line in f:
+            row = line.split()
+            if(len(row) >= 2 and not line.startswith('#')):
+                lengths[row[0]] = row[1]
+    return(lengths)
+
+
+class Blasttab:
+    '''
+    Streams rows from a tabular BLAST report (-outfmt 6 or 7) into a writer,
+    numbering hits and hsps in the order BLAST reports them
+    '''
+    def __init__(self, args, writer, lengths=None):
+        self.args = args
+        self.writer = writer
+        self.lengths = lengths or {}
+        self.fields = _check_fields(parse_outfmt(args.outfmt))
+        self.databases = []
+        self.root = {
+            'collection'          : args.collection,
+            'db_desc'             : args.db_desc,
+            'BlastOutput_program' : args.program,
+            'BlastOutput_version' : args.blast_version or args.program
+        }
+        self.root.update(PARAMETERS)
+        for param in (args.param or ()):
+            key, val = param.split('=', 1)
+            self.root['Parameters_' + key.replace('-', '_')] = val
+        if(args.blast_db):
+            self._set_db(args.blast_db)
+        self.query_def = None
+        self.iter_num = 0
+        self.query = None
+        self.hit = None
+        self.hit_num = 0
+        self.hsp_num = 0
+        self.cols = {}
+        self.warned = False
+
+    def read(self, f):
+        for line in f:
+            if(line.startswith('#')):
+                self._comment(line)
+            elif(not line.isspace()):
+                # Rows are keyed by database, it must be known before the
+                # first one reaches the writer
+                self._check_db()
+                self.add(line.rstrip('\r\n').split('\t'))
+        self._check_db()
+
+    def add(self, values):
+        dat = dict(zip(self.fields, values))
+        qseqid = dat['qseqid']
+        sseqid = dat.get('sseqid')
+        if(qseqid != self.query):
+            self.query = qseqid
+            self.iter_num += 1
+            self.hit = None
+            self.hit_num = 0
+        if(sseqid != self.hit or sseqid is None):
+            self.hit = sseqid
+            self.hit_num += 1
+            self.hsp_num = 0
+        self.hsp_num += 1
+
+        if(self.hit_num > self.args.max_hits or not self._keep_hsp(dat)):
+            return
+
+        row = dict(self.root)
+        for field, val in dat.items():
+            try:
+                row[FIELD2COLUMN[field]] = val
+            except KeyError:
+                pass
+        if('Hsp_identity' not in row and 'pident' in dat and 'length' in dat):
+            row['Hsp_identity'] = round(float(dat['pident']) * int(dat['length']) / 100)
+        if(self.args.small):
+            row.pop('Hsp_qseq', None)
+            row.pop('Hsp_hseq', None)
+        if('Iteration_query_len' not in row):
+            row['Iteration_query_len'] = self._query_len(qseqid)
+        row['Iteration_iter_num'] = self.iter_num
+        row['Iteration_query_ID'] = qseqid
+        if(self.query_def and self.query_def.split()[:1] == [qseqid]):
+            row['Iteration_query_def'] = self.query_def
+        row['Hit_num'] = self.hit_num
+        row['Hsp_num'] = self.hsp_num
+
+        order = tuple(row)
+        try:
+            col = self.cols[order]
+        except KeyError:
+            col = self.cols[order] = tuple(sorted(order))
+        self.writer.add(col, tuple(map(row.get, col)))
+
+    def _keep_hsp(self, dat):
+        args = self.args
+        if(args.max_hsps is not None and self.hsp_num > args.max_hsps):
+            return False
+        if(args.max_evalue is not None and 'evalue' in dat and
+           float(dat['evalue']) > args.max_evalue):
+            return False
+        if(args.min_bitscore is not None and 'bitscore' in dat and
+           float(dat['bitscore']) < args.min_bitscore):
+            return False
+        return True
+
+    def _query_len(self, qseqid):
+        try:
+            return(self.lengths[qseqid])
+        except KeyError:
+            if(not self.warned):
+                print("Query lengths unknown (add qlen to -outfmt or use "
+                      "--query-lengths), storing NULL: length and coverage "
+                      "filters will skip these queries", file=sys.stderr)
+                self.warned = True
+            return(None)
+
+    def _comment(self, line):
+        line = line[1:].strip()
+        if(':' in line):
+            key, val = (x.strip() for x in line.split(':', 1))
+        else:
+            key, val = ('', line)
+        if(key == 'Fields'):
+            self.fields = _check_fields(tuple(LONG2FIELD.get(x.strip(), x.strip())
+                                              for x in val.split(',')))
+        elif(key == 'Database' and not self.args.blast_db):
+            self._set_db(val)
+        elif(key == 'Query'):
+            self.query_def = val
+        elif(re.match(r'T?BLAST[NPX]', val)):
+            self.root['BlastOutput_program'] = val.split()[0].lower()
+            if(not self.args.blast_version):
+                self.root['BlastOutput_version'] = val
+
+    def _check_db(self):
+        if('BlastOutput_db' not in self.root):
+            print("No database name found in the tabular report, use --blast-db",
+                  file=sys.stderr)
+            sys.exit(1)
+
+    def _set_db(self, path):
+        base = os.path.basename(path)
+        self.root['BlastOutput_db'] = base
+        if(base not in self.databases):
+            self.databases.append(base)
+
+
+# =================
+# UTILITY FUNCTIONS
+# =================
+
+def _check_fields(fields):
+    if('qseqid' not in fields):
+        print("Tabular reports must include the qseqid field", file=sys.stderr)
+        sys.exit(1)
+    return(fields)
@@ -0,0 +1,127 @@
+#! /usr/bin/python3
+
+import bz2
+import gzip
+import io
+import lzma
+import queue
+import sys
+import threading
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# =========
+# CONSTANTS
+# =========
+
+MAGIC = (
+    (b'\x1f\x8b', 'gzip'),
+    (b'BZh', 'bz2'),
+    (b'\xfd7zXZ\x00', 'xz'),
+    (b'\x28\xb5\x2f\xfd', 'zstd'))
+
+
+# ==================
+# EXPORTED FUNCTIONS
+# ==================
+
+def open_input(filename, chunksize=2**20, depth=8):
+    '''
+    Opens a (possibly compressed) file, or stdin for '-', as text. The
+    compression is detected from the leading bytes. Compressed input is
+    decompressed in a background thread, up to depth chunks ahead of the
+    reader, so decompression overlaps with parsing and writing.
+    '''
+    if(filename == '-'):
+        raw = sys.stdin.buffer
+    else:
+        try:
+            raw = open(filename, 'rb')
+        except OSError as e:
+            print("Cannot open {}: {}".format(filename, e), file=sys.stderr)
+            sys.exit(1)
+    if(not hasattr(raw, 'peek')):
+        raw = io.BufferedReader(raw)
+
+    fmt = detect_compression(raw.peek(6)[:6])
+    if(fmt is None):
+        return(io.TextIOWrapper(raw))
+
+    stream = _decompressor(fmt, raw, filename)
+    reader = io.BufferedReader(ThreadedReader(stream, chunksize, depth, raw),
+                               chunksize)
+    return(io.TextIOWrapper(reader))
+
+def detect_compression(head):
+    for magic, fmt in MAGIC:
+        if(head.startswith(magic)):
+            return(fmt)
+    return(None)
+
+
+class ThreadedReader(io.RawIOBase):
+    '''
+    Reads a stream in a background thread, handing over chunks through a
+    bounded queue
+    '''
+    def __init__(self, stream, chunksize=2**20, depth=8, source=None):
+        self.queue = queue.Queue(depth)
+        self.buf = memoryview(b'')
+        self.eof = False
+        self.thread = threading.Thread(target=self._fill,
+                                       args=(stream, chunksize, source),
+                                       daemon=True)
+        self.thread.start()
+
+    def _fill(self, stream, chunksize, source):
+        try:
+            while(True):
+                chunk = stream.read(chunksize)
+                if(not chunk):
+                    break
+                self.queue.put(chunk)
+            self.queue.put(b'')
+        except Exception as e:
+            self.queue.put(e)
+        finally:
+            stream.close()
+            if(source is not None):
+                source.close()
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if(not self.buf and not self.eof):
+            item = self.queue.get()
+            if(isinstance(item, Exception)):
+                raise item
+            if(not item):
+                self.eof = True
+            self.buf = memoryview(item)
+        n = min(len(b), len(self.buf))
+        b[:n] = self.buf[:n]
+        self.buf = self.buf[n:]
+        return(n)
+
+
+# =================
+# UTILITY FUNCTIONS
+# =================
+
+def _decompressor(fmt, raw, filename):
+    if(fmt == 'gzip'):
+        return(gzip.GzipFile(fileobj=raw))
+    elif(fmt == 'bz2'):
+        return(bz2.BZ2File(raw))
+    elif(fmt == 'xz'):
+        return(lzma.LZMAFile(raw))
+    elif(zstandard is None):
+        print("{} is zstd compressed, install the 'zstandard' module to read it".format(
+              filename), file=sys.stderr)
+        sys.exit(1)
+    else:
+        return(zstandard.ZstdDecompressor().stream_reader(raw, read_across_frames=True))
@@ -6,6 +6,9 @@ import sys
 
 import lib.meta as meta
 import lib.initialize as init
+import lib.maxhsp as maxhsp
+import lib.phylostrata as phylostrata
+import lib.shard as shard
 import lib.sqlite_interface as misc
 
 def parse(parent, *args, **kwargs):
@@ -29,6 +32,13 @@ def parse(parent, *args, **kwargs):
         help="Destroy current blastdatabase file (does not lose blast results)",
         action='store_true',
         default=False)
+    db_parser.add_argument(
+        '-p', '--phylostrata',
+        help="Also keep the phylostrata of every query for this criterion, "
+             "e.g. 'score 50' or 'evalue 1e-5' ('score 100' is always kept)",
+        metavar=('CRITERION', 'CUTOFF'),
+        nargs=2,
+        action='append')
     db_parser.set_defaults(func=update)
 
     dump_parser = parent.add_parser(
@@ -38,12 +48,30 @@ def parse(parent, *args, **kwargs):
     dump_parser.add_argument(
         '--mrca',
         help="Dumps MRCA data relative to given taxon id")
-    dump_parser.set_defaults(func=dump_dbinfo)
+    dump_parser.set_defaults(func=dump_dbinfo, readonly=True)
 
 def update(args, cur, con=None):
-    meta.update_dbinfo(cur, deep=args.deep, destroy=args.destroy)
+    if(not shard.is_sharded(cur)):
+        meta.update_dbinfo(cur, deep=args.deep, destroy=args.destroy)
+        meta.update_mrca(cur, sync=True, taxids=args.taxids)
+        meta.update_besthits(cur, con)
+        phylostrata.refresh(cur, criteria=args.phylostrata or (), verbose=True)
+        maxhsp.refresh(cur, verbose=True)
+        misc.checkpoint(cur, 'TRUNCATE')
+        return
+    # BlastReport and BestHits live in the shards. Phylostrata are not
+    # materialized (nor is MaxHsp), phylo and maxattr merge across shards on
+    # every run.
+    shards = shard.ShardSet(cur, args.sqldb)
+    report_curs = [scur for key, scur in shards.cursors()]
+    meta.update_dbinfo(cur, deep=args.deep, destroy=args.destroy,
+                       report_curs=report_curs)
     meta.update_mrca(cur, sync=True, taxids=args.taxids)
-    meta.update_besthits(cur, con)
+    cur.connection.commit()
+    for scur in report_curs:
+        meta.update_besthits(scur, scur.connection)
+        misc.checkpoint(scur, 'TRUNCATE')
+    misc.checkpoint(cur, 'TRUNCATE')
 
 def dump_dbinfo(args, cur):
     if args.mrca:
@@ -0,0 +1,245 @@
+#! /usr/bin/python3
+
+import sys
+
+import lib.initialize as initialize
+import lib.shard as shard
+import lib.sqlite_interface as misc
+
+# =========
+# CONSTANTS
+# =========
+
+# Covering indices for the report queries: (name, table, columns, where,
+# use). The leading columns are those filtered on, then those grouped by,
+# then those read, so the queries never touch the (wide) table rows. The
+# identifier columns are often all NULL, their indices only keep the rows
+# that can match (and so stay tiny rather than look useless to the planner).
+FLAT_INDICES = (
+    ('seqid_score_idx', 'BlastReport',
+     ('query_seqid', 'collection', 'blastoutput_db', 'hsp_bit_score', 'hsp_evalue',
+      'query_taxon'), None,
+     "mat, phylo and spec by seqid"),
+    ('locus_score_idx', 'BlastReport',
+     ('query_locus', 'collection', 'blastoutput_db', 'hsp_bit_score', 'hsp_evalue',
+      'query_taxon'), 'query_locus IS NOT NULL',
+     "mat, phylo and spec by locus"),
+    ('gb_score_idx', 'BlastReport',
+     ('query_gb', 'collection', 'blastoutput_db', 'hsp_bit_score', 'hsp_evalue',
+      'query_taxon'), 'query_gb IS NOT NULL',
+     "mat, phylo and spec by gb"),
+    ('gi_score_idx', 'BlastReport',
+     ('query_gi', 'collection', 'blastoutput_db', 'hsp_bit_score', 'hsp_evalue',
+      'query_taxon'), 'query_gi IS NOT NULL',
+     "mat, phylo and spec by gi"),
+    ('collection_score_idx', 'BlastReport',
+     ('collection', 'query_seqid', 'blastoutput_db', 'hsp_bit_score', 'hsp_evalue'),
+     None,
+     "mat --all, mat and phylo by seqid with -c, identifiers of a collection (-c)"))
+
+# In the normalized layout scores are already keyed by (database, query), so
+# only the query identifiers and the collection need indices
+NORMALIZED_INDICES = (
+    ('locus_idx', 'BlastQuery', ('query_locus', 'query_taxon'),
+     'query_locus IS NOT NULL', "mat, phylo and spec by locus"),
+    ('gb_idx', 'BlastQuery', ('query_gb', 'query_taxon'),
+     'query_gb IS NOT NULL', "mat, phylo and spec by gb"),
+    ('gi_idx', 'BlastQuery', ('query_gi', 'query_taxon'),
+     'query_gi IS NOT NULL', "mat, phylo and spec by gi"),
+    ('collection_idx', 'BlastRun', ('collection', ), None,
+     "mat --all and identifiers of a collection (-c)"))
+
+# Identifiers 'index check' puts in the temporary tables of the statements
+CHECK_VALUES = 100
+
+# Statements (with placeholders) of the query subcommands, whose plans are
+# reported by 'index check'. Identifiers are read from the temporary tables
+# filled by misc.temp_values.
+QUERIES = (
+    ("query mat -e seqid",
+     "select v.value, r.blastoutput_db, max(r.hsp_bit_score) "
+     "from temp.mat_queries v join blastreport r on r.query_seqid = v.value "
+     "group by v.value, r.blastoutput_db"),
+    ("query mat -e seqid -c",
+     "select v.value, r.blastoutput_db, max(r.hsp_bit_score) "
+     "from temp.mat_queries v join blastreport r on r.query_seqid = v.value "
+     "and r.collection = ? group by v.value, r.blastoutput_db"),
+    ("query mat -e locus",
+     "select v.value, r.blastoutput_db, max(r.hsp_bit_score) "
+     "from temp.mat_queries v join blastreport r on r.query_locus = v.value "
+     "group by v.value, r.blastoutput_db"),
+    ("query mat --all -c",
+     "select query_seqid, blastoutput_db, max(hsp_bit_score) from blastreport "
+     "where collection = ? group by query_seqid, blastoutput_db"),
+    ("query phylo -c (identifiers)",
+     "select distinct query_seqid from blastreport where collection = ?"),
+    ("query phylo -e gb (query info)",
+     "select v.value, {} from temp.info_values v "
+     "join blastreport r on r.query_gb = v.value group by v.pos".format(
+        ','.join('r.' + x[0] for x in misc.QUERY_INFO_FIELDS))),
+    ("query phylo -e gb (spec)",
+     misc.SPEC_BATCH.format('query_gb', 'temp.spec_values', 'r.hsp_bit_score >= ?')),
+    ("update (besthits)",
+     "select blastoutput_db, query_seqid, hit_num, hsp_num, hsp_bit_score "
+     "from blastreport order by blastoutput_db, query_seqid"))
+
+
+# ==================
+# EXPORTED FUNCTIONS
+# ==================
+
+def parse(parent, *args, **kwargs):
+    parser = parent.add_parser(
+        'index',
+        help="Create, drop, list or check the indices used by queries",
+        parents=args)
+    parser.add_argument(
+        'action',
+        help="'list' the indices, 'create' or 'drop' the curated ones, or "
+             "'check' which indices the query subcommands use",
+        choices=['list', 'create', 'drop', 'check'],
+        nargs='?',
+        default='list')
+    parser.add_argument(
+        'names',
+        help="Curated indices to create or drop (default all)",
+        metavar="NAME",
+        nargs='*')
+    parser.set_defaults(func=index)
+
+def index(args, cur):
+    if(shard.is_sharded(cur)):
+        # The report tables, and so their indices, live in the shards
+        shards = shard.ShardSet(cur, args.sqldb)
+        for key, scur in shards.cursors():
+            print("== shard {} ({})".format(key, shards.paths[key]))
+            _index(args, scur)
+        return
+    _index(args, cur)
+
+def _index(args, cur):
+    if(not misc.table_exists('blastreport', cur)):
+        print("{} holds no BLAST results".format(args.sqldb), file=sys.stderr)
+        sys.exit(1)
+    if(args.action == 'list'):
+        list_indices(cur)
+    elif(args.action == 'check'):
+        check_queries(cur)
+    else:
+        chosen = _choose(args.names, cur)
+        for i, (name, table, columns, where, use) in enumerate(chosen, 1):
+            if(args.action == 'create'):
+                create_index(name, table, columns, cur, where=where,
+                             label="{} ({}/{})".format(name, i, len(chosen)))
+            else:
+                misc.execute("DROP INDEX IF EXISTS {}".format(name), cur)
+                if(misc.table_exists('deferredindex', cur)):
+                    # Not to be rebuilt after an interrupted bulk load either
+                    misc.execute("DELETE FROM DeferredIndex WHERE name = ?",
+                                 cur, (name, ))
+                print("Dropped {}".format(name), file=sys.stderr)
+        cur.connection.commit()
+
+def curated(cur):
+    if(misc.table_exists('blastquery', cur)):
+        return(NORMALIZED_INDICES)
+    return(FLAT_INDICES)
+
+def create_index(name, table, columns, cur, where=None, label=None):
+    if(_index_exists(name, cur)):
+        print("{} exists".format(name), file=sys.stderr)
+        return
+    nrows = misc.fetch("SELECT count(*) FROM {}".format(table), cur)[0][0]
+    label = label or name
+    print("Building {} on {} ({} rows)".format(label, table, nrows), file=sys.stderr)
+    sql = "CREATE INDEX {} ON {} ({})".format(name, table, ', '.join(columns))
+    if(where):
+        sql += " WHERE {}".format(where)
+    initialize.build_index(sql, cur, verbose=True, label=label)
+    misc.execute("ANALYZE {}".format(name), cur)
+
+def list_indices(cur):
+    names = {x[0]: x[4] for x in curated(cur)}
+    sizes = _index_sizes(cur)
+    cmd = """SELECT name, tbl_name, sql FROM sqlite_master
+             WHERE type = 'index' ORDER BY tbl_name, name"""
+    print("{:<32} {:<14} {:>12}  {}".format('index', 'table', 'bytes', 'use'))
+    for name, table, sql in misc.fetch(cmd, cur):
+        if(sql is None):
+            use = 'primary key'
+        else:
+            use = names.pop(name, '')
+        print("{:<32} {:<14} {:>12}  {}".format(name, table, sizes.get(name, ''), use))
+    for name, use in names.items():
+        print("{:<32} {:<14} {:>12}  {} (not created)".format(name, '', '', use))
+
+def check_queries(cur):
+    '''
+    Prints the indices each query subcommand statement would use, and
+    whether it scans a whole table or sorts in a temporary b-tree
+    '''
+    # Filled as a query would fill them, so the plans use their statistics
+    values = ['value{}'.format(i) for i in range(CHECK_VALUES)]
+    for name in ('mat_queries', 'info_values', 'spec_values'):
+        misc.temp_values(values, cur, name=name)
+    # Scans of the identifier table (v) and of the intermediate results of
+    # a statement (its CTEs) are by design, only scans of stored tables count
+    tables = {x[0].lower() for x in misc.fetch(
+              "SELECT name FROM sqlite_master WHERE type IN ('table', 'view')", cur)}
+    tables.add('r')
+    for label, cmd in QUERIES:
+        nparams = cmd.count('?')
+        try:
+            plan = cur.execute('EXPLAIN QUERY PLAN ' + cmd, (None, ) * nparams).fetchall()
+        except Exception as e:
+            # e.g. the MRCA table is only made by 'update'
+            print("{}\n    not available: {}".format(label, e))
+            continue
+        details = [row[3] for row in plan]
+        used = sorted(set(_plan_index(x) for x in details) - {None})
+        notes = []
+        if(any(x.startswith('SCAN ') and 'INDEX' not in x and
+               x.split()[1].lower() in tables for x in details)):
+            notes.append('full scan')
+        if(any('TEMP B-TREE' in x for x in details)):
+            notes.append('temp b-tree')
+        print("{}\n    uses: {}{}".format(
+              label, ', '.join(used) or 'no index',
+              ' ({})'.format(', '.join(notes)) if notes else ''))
+
+
+# =================
+# UTILITY FUNCTIONS
+# =================
+
+def _choose(names, cur):
+    available = curated(cur)
+    if(not names):
+        return(available)
+    known = {x[0]: x for x in available}
+    unknown = [x for x in names if x not in known]
+    if(unknown):
+        print("Unknown index {}, choose from: {}".format(
+              ', '.join(unknown), ', '.join(known)), file=sys.stderr)
+        sys.exit(1)
+    return([known[x] for x in names])
+
+def _index_exists(name, cur):
+    return(bool(misc.fetch("SELECT name FROM sqlite_master WHERE type = 'index' "
+                           "AND name = ? COLLATE NOCASE", cur, (name, ))))
+
+def _index_sizes(cur):
+    try:
+        rows = cur.execute("SELECT name, sum(pgsize) FROM dbstat GROUP BY name").fetchall()
+    except Exception:
+        # SQLite built without the dbstat table
+        return({})
+    return(dict(rows))
+
+def _plan_index(detail):
+    for marker in ('USING COVERING INDEX ', 'USING INDEX '):
+        if(marker in detail):
+            return(detail.split(marker)[1].split()[0])
+    if('USING PRIMARY KEY' in detail or 'USING INTEGER PRIMARY KEY' in detail):
+        return('primary key')
+    return(None)
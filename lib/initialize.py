@@ -3,6 +3,18 @@
 import lib.sqlite_interface as misc
 import traceback
 import sys
+import time
+
+# =========
+# CONSTANTS
+# =========
+
+# Virtual machine steps between progress reports of an index build
+PROGRESS_STEPS = 10**7
+
+# Finds the files holding a (database, query) pair, see manifest.forget
+LOADEDQUERY_KEY_IDX = ("CREATE INDEX IF NOT EXISTS loadedquery_key_idx "
+                       "ON LoadedQuery (database, query_seqid)")
 
 # ==================
 # EXPORTED FUNCTIONS
@@ -17,16 +29,18 @@ def init_blastreport(cur, verbose=False):
         BlastOutput_program   TEXT NOT NULL COLLATE NOCASE,
         BlastOutput_version   TEXT NOT NULL COLLATE NOCASE,
         BlastOutput_db        TEXT NOT NULL COLLATE NOCASE,
-        Parameters_matrix     TEXT NOT NULL COLLATE NOCASE,
-        Parameters_expect     REAL NOT NULL,
-        Parameters_gap_open   INTEGER NOT NULL,
-        Parameters_gap_extend INTEGER NOT NULL,
-        Parameters_filter     TEXT NOT NULL COLLATE NOCASE,
+        -- NULL when the report does not give them (tabular reports)
+        Parameters_matrix     TEXT COLLATE NOCASE,
+        Parameters_expect     REAL,
+        Parameters_gap_open   INTEGER,
+        Parameters_gap_extend INTEGER,
+        Parameters_filter     TEXT COLLATE NOCASE,
 
         Iteration_iter_num   INTEGER NOT NULL,
         Iteration_query_ID   TEXT NOT NULL COLLATE NOCASE,
         Iteration_query_def  TEXT COLLATE NOCASE,
-        Iteration_query_len  INTEGER NOT NULL,
+        -- NULL for tabular reports without qlen or --query-lengths
+        Iteration_query_len  INTEGER,
         Iteration_message    TEXT COLLATE NOCASE,
 
         Statistics_db_num    INTEGER,
@@ -107,6 +121,193 @@ def init_blastreport(cur, verbose=False):
         "CREATE INDEX Iteration_iter_num_idx ON BlastReport (Iteration_iter_num)")
     create_table(cur, cmds)
 
+def init_normalized(cur, hsp_without_rowid=False, verbose=False):
+    '''
+    Creates the normalized report layout: one BlastRun row per program and
+    parameter set, one BlastQuery row per query iteration, then BlastHit and
+    BlastHsp rows. The BlastReport view joins them back into the flat table
+    layout, so everything that reads BlastReport keeps working. BlastHsp is
+    only a WITHOUT ROWID table if told its rows are small (no alignments).
+    '''
+    RUN_VAL = """
+        run_id INTEGER PRIMARY KEY,
+
+        -- User Input
+        collection TEXT COLLATE NOCASE,
+        db_desc    TEXT COLLATE NOCASE,
+
+        BlastOutput_program   TEXT NOT NULL COLLATE NOCASE,
+        BlastOutput_version   TEXT NOT NULL COLLATE NOCASE,
+        -- NULL when the report does not give them (tabular reports)
+        Parameters_matrix     TEXT COLLATE NOCASE,
+        Parameters_expect     REAL,
+        Parameters_gap_open   INTEGER,
+        Parameters_gap_extend INTEGER,
+        Parameters_filter     TEXT COLLATE NOCASE,
+
+        CHECK(Parameters_expect >= 0),
+        CHECK(Parameters_gap_open >= 0),
+        CHECK(Parameters_gap_extend >= 0)
+        """
+
+    QUERY_VAL = """
+        BlastOutput_db TEXT NOT NULL COLLATE NOCASE,
+        Query_seqid    TEXT NOT NULL COLLATE NOCASE,
+        run_id         INTEGER NOT NULL REFERENCES BlastRun(run_id),
+
+        Iteration_iter_num   INTEGER NOT NULL,
+        Iteration_query_ID   TEXT NOT NULL COLLATE NOCASE,
+        Iteration_query_def  TEXT COLLATE NOCASE,
+        -- NULL for tabular reports without qlen or --query-lengths
+        Iteration_query_len  INTEGER,
+        Iteration_message    TEXT COLLATE NOCASE,
+
+        Statistics_db_num    INTEGER,
+        Statistics_db_len    INTEGER,
+        Statistics_hsp_len   INTEGER,
+        Statistics_eff_space REAL,
+        Statistics_kappa     REAL,
+        Statistics_lambda    REAL,
+        Statistics_entropy   REAL,
+
+        Query_locus TEXT COLLATE NOCASE,
+        Query_gi    TEXT ,
+        Query_gb    TEXT COLLATE NOCASE,
+        Query_gene  TEXT COLLATE NOCASE,
+        Query_taxon TEXT,
+
+        CHECK(Iteration_iter_num >= 0),
+        CHECK(Iteration_query_len >= 0),
+        CHECK(Statistics_db_num >= 0),
+        CHECK(Statistics_db_len >= 0),
+        CHECK(Statistics_hsp_len >= 0),
+        CHECK(Statistics_eff_space >= 0)
+
+        PRIMARY KEY(blastoutput_db, query_seqid)
+        """
+
+    HIT_VAL = """
+        BlastOutput_db TEXT NOT NULL COLLATE NOCASE,
+        Query_seqid    TEXT NOT NULL COLLATE NOCASE,
+        Hit_num        INTEGER DEFAULT 0,
+        Hit_id         TEXT COLLATE NOCASE,
+        Hit_def        TEXT COLLATE NOCASE,
+        Hit_accession  TEXT COLLATE NOCASE,
+        Hit_len        INTEGER,
+
+        CHECK(Hit_num >= 0),
+        CHECK(Hit_len >= 0)
+
+        PRIMARY KEY(blastoutput_db, query_seqid, hit_num)
+        """
+
+    HSP_VAL = """
+        BlastOutput_db  TEXT NOT NULL COLLATE NOCASE,
+        Query_seqid     TEXT NOT NULL COLLATE NOCASE,
+        Hit_num         INTEGER DEFAULT 0,
+        Hsp_num         INTEGER DEFAULT 0,
+        Hsp_bit_score   REAL DEFAULT 0,
+        Hsp_score       REAL DEFAULT 0,
+        Hsp_evalue      REAL,
+        Hsp_query_from  INTEGER,
+        Hsp_query_to    INTEGER,
+        Hsp_hit_from    INTEGER,
+        Hsp_hit_to      INTEGER,
+        Hsp_query_frame INTEGER,
+        Hsp_hit_frame   INTEGER,
+        Hsp_identity    INTEGER DEFAULT 0,
+        Hsp_positive    INTEGER DEFAULT 0,
+        Hsp_align_len   INTEGER DEFAULT 0,
+        Hsp_gaps        INTEGER DEFAULT 0,
+        Hsp_qseq        TEXT COLLATE NOCASE,
+        Hsp_hseq        TEXT COLLATE NOCASE,
+        Hsp_midline     TEXT COLLATE NOCASE,
+
+        CHECK(Hsp_num >= 0),
+        CHECK(Hsp_bit_score >= 0),
+        CHECK(Hsp_score >= 0),
+        CHECK(Hsp_evalue >= 0),
+        CHECK(Hsp_identity >= 0),
+        CHECK(Hsp_positive >= 0),
+        CHECK(Hsp_align_len >= 0),
+        CHECK(Hsp_gaps >= 0)
+
+        PRIMARY KEY(blastoutput_db, query_seqid, hit_num, hsp_num)
+        """
+
+    VIEW = """
+        SELECT
+            r.collection, r.db_desc,
+            r.BlastOutput_program, r.BlastOutput_version, q.BlastOutput_db,
+            r.Parameters_matrix, r.Parameters_expect, r.Parameters_gap_open,
+            r.Parameters_gap_extend, r.Parameters_filter,
+            q.Iteration_iter_num, q.Iteration_query_ID, q.Iteration_query_def,
+            q.Iteration_query_len, q.Iteration_message,
+            q.Statistics_db_num, q.Statistics_db_len, q.Statistics_hsp_len,
+            q.Statistics_eff_space, q.Statistics_kappa, q.Statistics_lambda,
+            q.Statistics_entropy,
+            q.Query_seqid, q.Query_locus, q.Query_gi, q.Query_gb, q.Query_gene,
+            q.Query_taxon,
+            h.Hit_num, h.Hit_id, h.Hit_def, h.Hit_accession, h.Hit_len,
+            s.Hsp_num, s.Hsp_bit_score, s.Hsp_score, s.Hsp_evalue,
+            s.Hsp_query_from, s.Hsp_query_to, s.Hsp_hit_from, s.Hsp_hit_to,
+            s.Hsp_query_frame, s.Hsp_hit_frame, s.Hsp_identity, s.Hsp_positive,
+            s.Hsp_align_len, s.Hsp_gaps, s.Hsp_qseq, s.Hsp_hseq, s.Hsp_midline
+        FROM BlastQuery q
+        INNER JOIN BlastRun r ON r.run_id = q.run_id
+        INNER JOIN BlastHit h ON
+            h.BlastOutput_db = q.BlastOutput_db AND
+            h.Query_seqid = q.Query_seqid
+        INNER JOIN BlastHsp s ON
+            s.BlastOutput_db = h.BlastOutput_db AND
+            s.Query_seqid = h.Query_seqid AND
+            s.Hit_num = h.Hit_num
+        """
+
+    hsp_opt = " WITHOUT ROWID" if hsp_without_rowid else ""
+    cmds = (
+        "DROP VIEW IF EXISTS BlastReport",
+        "DROP TABLE IF EXISTS BlastHsp",
+        "DROP TABLE IF EXISTS BlastHit",
+        "DROP TABLE IF EXISTS BlastQuery",
+        "DROP TABLE IF EXISTS BlastRun",
+        "CREATE TABLE BlastRun(" + RUN_VAL + ")",
+        "CREATE TABLE BlastQuery(" + QUERY_VAL + ") WITHOUT ROWID",
+        "CREATE TABLE BlastHit(" + HIT_VAL + ") WITHOUT ROWID",
+        "CREATE TABLE BlastHsp(" + HSP_VAL + ")" + hsp_opt,
+        "CREATE INDEX query_seqid_idx ON BlastQuery (query_seqid)",
+        "CREATE INDEX Iteration_iter_num_idx ON BlastQuery (Iteration_iter_num)",
+        "CREATE VIEW BlastReport AS " + VIEW)
+    create_table(cur, cmds)
+
+def init_hspalignment(cur, verbose=False):
+    # Alignment strings packed by sqlite_interface.pack_alignment, keyed like
+    # BlastReport. The BlastAlignment view decodes them only when selected.
+    ALIGNMENT_VAL = """
+        BlastOutput_db TEXT NOT NULL COLLATE NOCASE,
+        Query_seqid    TEXT NOT NULL COLLATE NOCASE,
+        Hit_num        INTEGER DEFAULT 0,
+        Hsp_num        INTEGER DEFAULT 0,
+        alignment      BLOB,
+        PRIMARY KEY(blastoutput_db, query_seqid, hit_num, hsp_num)
+    """
+
+    VIEW = """
+        SELECT
+            BlastOutput_db, Query_seqid, Hit_num, Hsp_num,
+            alignment(alignment, 'qseq')    AS Hsp_qseq,
+            alignment(alignment, 'hseq')    AS Hsp_hseq,
+            alignment(alignment, 'midline') AS Hsp_midline
+        FROM HspAlignment
+    """
+
+    cmds = (
+        "DROP VIEW IF EXISTS BlastAlignment",
+        "DROP TABLE IF EXISTS HspAlignment",
+        "CREATE TABLE HspAlignment(" + ALIGNMENT_VAL + ")",
+        "CREATE VIEW BlastAlignment AS " + VIEW)
+    create_table(cur, cmds)
+
 def init_blastdatabase(cur, verbose=False):
     DATABASE_VAL = """
         database TEXT PRIMARY KEY,
@@ -149,6 +350,33 @@ def init_taxid2name(cur, verbose=False):
         "CREATE TABLE Taxid2Name(" + TAX2NAME_VAL + ")")
     create_table(cur, cmds)
 
+def init_taxonomystate(cur, verbose=False):
+    # The taxonomy generation, moved on by every write to BlastDatabase,
+    # MRCA or Taxid2Name
+    STATE_VAL = """
+        name  TEXT PRIMARY KEY,
+        value TEXT
+    """
+
+    cmds = (
+        "DROP TABLE IF EXISTS TaxonomyState",
+        "CREATE TABLE TaxonomyState(" + STATE_VAL + ")")
+    create_table(cur, cmds)
+
+def init_lineage(cur, verbose=False):
+    # Ancestors of each taxid from the root down, names are in Taxid2Name
+    LINEAGE_VAL = """
+        taxid    INTEGER NOT NULL CHECK(taxid >= 0),
+        depth    INTEGER NOT NULL CHECK(depth >= 0),
+        ancestor INTEGER NOT NULL CHECK(ancestor >= 0),
+        PRIMARY KEY(taxid, depth)
+    """
+
+    cmds = (
+        "DROP TABLE IF EXISTS Lineage",
+        "CREATE TABLE Lineage(" + LINEAGE_VAL + ")")
+    create_table(cur, cmds)
+
 def init_besthits(cur, verbose=False):
     BESTHITS_VAL = \
     """
@@ -160,7 +388,7 @@ def init_besthits(cur, verbose=False):
     qgi,
     qlocus,
     qtaxon INTEGER,
-    qlen   INTEGER NOT NULL,
+    qlen   INTEGER,
 
     -- Summed HSP values
     snhsp,
@@ -230,6 +458,240 @@ def init_besthits(cur, verbose=False):
         )
     create_table(cur, cmds)
 
+def init_loadedfile(cur, verbose=False):
+    # One row per ingested report file, hash is NULL while a load is underway
+    LOADEDFILE_VAL = """
+        path      TEXT PRIMARY KEY,
+        size      INTEGER,
+        mtime     REAL,
+        hash      TEXT,
+        databases TEXT,
+        nqueries  INTEGER,
+        loaded    TEXT
+    """
+
+    # The BlastReport (database, query) pairs each file contributed
+    LOADEDQUERY_VAL = """
+        path        TEXT NOT NULL,
+        database    TEXT NOT NULL COLLATE NOCASE,
+        query_seqid TEXT NOT NULL COLLATE NOCASE,
+        PRIMARY KEY(path, database, query_seqid)
+    """
+
+    cmds = (
+        "DROP TABLE IF EXISTS LoadedFile",
+        "DROP TABLE IF EXISTS LoadedQuery",
+        "CREATE TABLE LoadedFile(" + LOADEDFILE_VAL + ")",
+        "CREATE TABLE LoadedQuery(" + LOADEDQUERY_VAL + ")",
+        LOADEDQUERY_KEY_IDX)
+    create_table(cur, cmds)
+
+def init_shard(cur, verbose=False):
+    # The shard files of a catalog database, path relative to the catalog
+    SHARD_VAL = """
+        key  TEXT PRIMARY KEY,
+        path TEXT NOT NULL UNIQUE
+    """
+
+    # How rows are assigned to shards and the layout of their tables
+    SHARDSETTING_VAL = """
+        name  TEXT PRIMARY KEY,
+        value TEXT
+    """
+
+    cmds = (
+        "DROP TABLE IF EXISTS Shard",
+        "DROP TABLE IF EXISTS ShardSetting",
+        "CREATE TABLE Shard(" + SHARD_VAL + ")",
+        "CREATE TABLE ShardSetting(" + SHARDSETTING_VAL + ")")
+    create_table(cur, cmds)
+
+def init_deferredindex(cur, verbose=False):
+    # Definitions of indices dropped for a bulk load, until they are rebuilt
+    DEFERRED_VAL = """
+        name TEXT PRIMARY KEY,
+        sql  TEXT NOT NULL
+    """
+
+    cmds = (
+        "DROP TABLE IF EXISTS DeferredIndex",
+        "CREATE TABLE DeferredIndex(" + DEFERRED_VAL + ")")
+    create_table(cur, cmds)
+
+def init_phylostrata(cur, verbose=False):
+    # Phylostratum of each query under each criterion, NULL if unknown
+    PHYLOSTRATA_VAL = """
+        criterion    TEXT NOT NULL,
+        cutoff       REAL NOT NULL,
+        query_seqid  TEXT NOT NULL COLLATE NOCASE,
+        phylostratum INTEGER,
+        PRIMARY KEY(criterion, cutoff, query_seqid)
+    """
+
+    # The criteria kept in Phylostrata and the generation they were last
+    # brought up to
+    CRITERION_VAL = """
+        criterion  TEXT NOT NULL,
+        cutoff     REAL NOT NULL,
+        generation INTEGER NOT NULL,
+        PRIMARY KEY(criterion, cutoff)
+    """
+
+    # Queries whose phylostrata changed since the last refresh
+    STALE_VAL = """
+        query_seqid TEXT PRIMARY KEY COLLATE NOCASE
+    """
+
+    # The generation counter and the taxonomy generation Phylostrata was
+    # last brought up to
+    STATE_VAL = """
+        name  TEXT PRIMARY KEY,
+        value TEXT
+    """
+
+    # Copies of the BlastDatabase and MRCA rows Phylostrata was computed
+    # from, to tell which queries a taxonomy change touches
+    DATABASE_VAL = """
+        database TEXT PRIMARY KEY,
+        taxid    INTEGER
+    """
+    MRCA_VAL = """
+        taxid_1      INTEGER NOT NULL,
+        taxid_2      INTEGER NOT NULL,
+        phylostratum INTEGER,
+        PRIMARY KEY(taxid_1, taxid_2)
+    """
+
+    cmds = (
+        "DROP TABLE IF EXISTS Phylostrata",
+        "DROP TABLE IF EXISTS PhylostrataCriterion",
+        "DROP TABLE IF EXISTS PhylostrataStale",
+        "DROP TABLE IF EXISTS PhylostrataState",
+        "DROP TABLE IF EXISTS PhylostrataDatabase",
+        "DROP TABLE IF EXISTS PhylostrataMRCA",
+        "CREATE TABLE Phylostrata(" + PHYLOSTRATA_VAL + ") WITHOUT ROWID",
+        "CREATE TABLE PhylostrataCriterion(" + CRITERION_VAL + ")",
+        "CREATE TABLE PhylostrataStale(" + STALE_VAL + ")",
+        "CREATE TABLE PhylostrataState(" + STATE_VAL + ")",
+        "CREATE TABLE PhylostrataDatabase(" + DATABASE_VAL + ")",
+        "CREATE TABLE PhylostrataMRCA(" + MRCA_VAL + ")")
+    create_table(cur, cmds)
+
+def init_maxhsp(cur, verbose=False):
+    # The best scoring HSP of each (database, query locus), with the
+    # taxonomy of the pair. Rows are found in BlastReport by the key
+    # (database, seqid, hit, hsp).
+    MAXHSP_VAL = """
+        database     TEXT NOT NULL COLLATE NOCASE,
+        locus        TEXT COLLATE NOCASE,
+        seqid        TEXT NOT NULL COLLATE NOCASE,
+        hit          INTEGER NOT NULL,
+        hsp          INTEGER NOT NULL,
+        score        REAL,
+        species      TEXT COLLATE NOCASE,
+        taxid        INTEGER,
+        phylostratum INTEGER,
+        mrca         INTEGER,
+        sciname      TEXT COLLATE NOCASE
+    """
+
+    # (database, locus) pairs whose best HSP must be found again
+    STALE_VAL = """
+        database TEXT NOT NULL COLLATE NOCASE,
+        locus    TEXT COLLATE NOCASE
+    """
+
+    # The taxonomy generation MaxHsp was last brought up to
+    STATE_VAL = """
+        name  TEXT PRIMARY KEY,
+        value TEXT
+    """
+
+    # Copies of the BlastDatabase and MRCA rows (with the name of the mrca)
+    # MaxHsp was built from, to tell which pairs a taxonomy change touches
+    DATABASE_VAL = """
+        database TEXT PRIMARY KEY,
+        species  TEXT COLLATE NOCASE,
+        taxid    INTEGER
+    """
+    MRCA_VAL = """
+        taxid_1      INTEGER NOT NULL,
+        taxid_2      INTEGER NOT NULL,
+        mrca         INTEGER,
+        phylostratum INTEGER,
+        sciname      TEXT COLLATE NOCASE,
+        PRIMARY KEY(taxid_1, taxid_2)
+    """
+
+    cmds = (
+        "DROP TABLE IF EXISTS MaxHsp",
+        "DROP TABLE IF EXISTS MaxHspStale",
+        "DROP TABLE IF EXISTS MaxHspState",
+        "DROP TABLE IF EXISTS MaxHspDatabase",
+        "DROP TABLE IF EXISTS MaxHspMRCA",
+        "CREATE TABLE MaxHsp(" + MAXHSP_VAL + ")",
+        "CREATE TABLE MaxHspStale(" + STALE_VAL + ")",
+        "CREATE TABLE MaxHspState(" + STATE_VAL + ")",
+        "CREATE TABLE MaxHspDatabase(" + DATABASE_VAL + ")",
+        "CREATE TABLE MaxHspMRCA(" + MRCA_VAL + ")",
+        "CREATE INDEX maxhsp_key_idx ON MaxHsp (database, locus)",
+        "CREATE INDEX maxhsp_order_idx ON MaxHsp (locus, phylostratum, mrca, database)")
+    create_table(cur, cmds)
+
+def drop_indices(table, cur):
+    '''
+    Drops the secondary indices of a table. Their definitions are kept in
+    DeferredIndex, so restore_indices rebuilds them even after a crash.
+    '''
+    if(not misc.table_exists('deferredindex', cur)):
+        init_deferredindex(cur)
+    cmd = """SELECT name, sql FROM sqlite_master
+             WHERE type = 'index' AND sql IS NOT NULL
+             AND tbl_name = ? COLLATE NOCASE"""
+    for name, sql in misc.fetch(cmd, cur, (table, )):
+        misc.insert({'name': name, 'sql': sql}, 'DeferredIndex', cur, replace=True)
+        misc.execute("DROP INDEX {}".format(name), cur)
+    cur.connection.commit()
+
+def restore_indices(cur, verbose=False):
+    '''
+    Rebuilds the indices dropped by drop_indices
+    '''
+    if(not misc.table_exists('deferredindex', cur)):
+        return
+    deferred = misc.fetch("SELECT name, sql FROM DeferredIndex", cur)
+    for i, (name, sql) in enumerate(deferred, 1):
+        label = "{} ({}/{})".format(name, i, len(deferred))
+        if(verbose):
+            print("Building index {}".format(label), file=sys.stderr)
+        exists = misc.fetch("SELECT name FROM sqlite_master WHERE type = 'index' "
+                            "AND name = ? COLLATE NOCASE", cur, (name, ))
+        if(not exists):
+            build_index(sql, cur, verbose=verbose, label=label)
+        misc.execute("DELETE FROM DeferredIndex WHERE name = ?", cur, (name, ))
+        cur.connection.commit()
+
+def build_index(sql, cur, verbose=False, label=None):
+    '''
+    Runs a CREATE INDEX statement, printing the label (the index name and
+    its place in the run) and the elapsed time every so often if verbose
+    (SQLite cannot tell how far along a build is)
+    '''
+    if(verbose):
+        prefix = "  {}: ".format(label) if label else "  "
+        start = time.time()
+        def progress():
+            print("\r{}{:.0f}s".format(prefix, time.time() - start), end='',
+                  file=sys.stderr)
+        cur.connection.set_progress_handler(progress, PROGRESS_STEPS)
+    try:
+        misc.execute(sql, cur)
+    finally:
+        if(verbose):
+            cur.connection.set_progress_handler(None, PROGRESS_STEPS)
+            print("\r{}done in {:.1f}s".format(prefix, time.time() - start),
+                  file=sys.stderr)
+
 
 # =================
 # UTILITY FUNCTIONS
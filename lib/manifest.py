@@ -0,0 +1,129 @@
+#! /usr/bin/python3
+
+import hashlib
+import os
+import sys
+import time
+
+import lib.initialize as initialize
+import lib.maxhsp as maxhsp
+import lib.phylostrata as phylostrata
+import lib.sqlite_interface as misc
+
+# =========
+# CONSTANTS
+# =========
+
+# Tables keyed by (blastoutput_db, query_seqid) that hold a file's rows
+REPORT_TABLES = ('BlastReport', 'HspAlignment', 'BlastQuery', 'BlastHit', 'BlastHsp')
+
+# ==================
+# EXPORTED FUNCTIONS
+# ==================
+
+def pending(filenames, cur, reload=False):
+    '''
+    Returns a FileState for each input file that is new or whose size or
+    mtime differ from the manifest, in input order. Files that look
+    unchanged are left out without being read.
+    '''
+    if(not misc.table_exists('loadedfile', cur)):
+        initialize.init_loadedfile(cur)
+    else:
+        # Manifests made before the index was
+        misc.execute(initialize.LOADEDQUERY_KEY_IDX, cur)
+    out = []
+    for filename in filenames:
+        try:
+            state = FileState(filename)
+        except OSError as e:
+            print("Cannot open {}: {}".format(filename, e), file=sys.stderr)
+            sys.exit(1)
+        known = misc.fetch("select size, mtime, hash from loadedfile where path = ?",
+                           cur, (state.path, ))
+        if(known and not reload):
+            size, mtime, state.known_hash = known[0]
+            if(state.known_hash is not None and
+               size == state.size and mtime == state.mtime):
+                continue
+        out.append(state)
+    return(out)
+
+def file_hash(filename, chunksize=2**20):
+    h = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        while(True):
+            chunk = f.read(chunksize)
+            if(not chunk):
+                break
+            h.update(chunk)
+    return(h.hexdigest())
+
+def forget(path, cur, shards=None):
+    '''
+    Deletes the BlastReport rows a file contributed (from every shard, if
+    sharded), but for queries another file also holds, and marks it as
+    being loaded. Until record is called the file
+    has no hash, so an interrupted load is redone (and its partial rows
+    removed) on the next run.
+    '''
+    if(shards is None):
+        report_curs = [cur]
+    else:
+        # Shard connections see LoadedQuery in the attached catalog
+        report_curs = [scur for key, scur in shards.cursors()]
+    phylostrata.invalidate(path, cur)
+    maxhsp.invalidate(path, cur)
+    for rcur in report_curs:
+        for table in REPORT_TABLES:
+            if(misc.table_exists(table, rcur, views=False)):
+                # Keys another file also holds keep their rows
+                misc.execute('''
+                    delete from {} where (blastoutput_db, query_seqid) in (
+                        select database, query_seqid from loadedquery q
+                        where path = ? and not exists (
+                            select 1 from loadedquery o
+                            where o.database = q.database
+                            and o.query_seqid = q.query_seqid
+                            and o.path != q.path))'''.format(table), rcur, (path, ))
+        rcur.connection.commit()
+    misc.execute("delete from loadedquery where path = ?", cur, (path, ))
+    misc.insert({'path': path, 'hash': None}, 'loadedfile', cur, replace=True)
+    cur.connection.commit()
+
+def record(state, databases, cur):
+    phylostrata.invalidate(state.path, cur)
+    maxhsp.invalidate(state.path, cur)
+    nqueries = misc.fetch(
+        "select count(distinct query_seqid) from loadedquery where path = ?",
+        cur, (state.path, ))[0][0]
+    misc.insert({'path': state.path,
+                 'size': state.size,
+                 'mtime': state.mtime,
+                 'hash': state.hash,
+                 'databases': ','.join(databases),
+                 'nqueries': nqueries,
+                 'loaded': time.strftime('%Y-%m-%d %H:%M:%S')},
+                'loadedfile', cur, replace=True)
+    cur.connection.commit()
+
+def touch(state, cur):
+    '''
+    Stores the new size and mtime of a file whose content has not changed
+    '''
+    misc.execute("update loadedfile set size = ?, mtime = ? where path = ?",
+                 cur, (state.size, state.mtime, state.path))
+    cur.connection.commit()
+
+
+class FileState:
+    def __init__(self, filename):
+        self.path = os.path.abspath(filename)
+        stat = os.stat(self.path)
+        self.size = stat.st_size
+        self.mtime = stat.st_mtime
+        self.hash = None
+        self.known_hash = None
+
+    def unchanged(self):
+        return(self.hash is not None and self.hash == self.known_hash)
@@ -0,0 +1,206 @@
+#! /usr/bin/python3
+
+import re
+import sys
+
+import lib.initialize as initialize
+import lib.meta as meta
+import lib.sqlite_interface as misc
+
+# =========
+# CONSTANTS
+# =========
+
+# The tables joined into MaxHsp, refresh does nothing until they exist
+TAXONOMY = ('blastdatabase', 'mrca', 'taxid2name')
+
+# The BlastDatabase and MRCA rows MaxHsp depends on, as they are ('live')
+# and as copied by refresh into MaxHspDatabase and MaxHspMRCA ('kept'). Of
+# the names of an mrca only the first is taken by SELECT_BEST.
+DATABASES = {'live': "SELECT database, species, taxid FROM BlastDatabase",
+             'kept': "SELECT database, species, taxid FROM MaxHspDatabase"}
+PAIRS = {'live': """SELECT m.taxid_1, m.taxid_2, m.mrca, m.phylostratum,
+                           (SELECT min(t.sciname) FROM Taxid2Name t
+                            WHERE t.taxid = m.mrca) AS sciname
+                    FROM MRCA m""",
+         'kept': """SELECT taxid_1, taxid_2, mrca, phylostratum, sciname
+                    FROM MaxHspMRCA"""}
+
+# Columns of the tables joined by misc.get_maxattr and the MaxHsp columns
+# holding them, so fields and conditions written for one work on the other
+COLUMNS = {'blastdatabase.species' : 'maxhsp.species',
+           'blastdatabase.taxid'   : 'maxhsp.taxid',
+           'mrca.phylostratum'     : 'maxhsp.phylostratum',
+           'mrca.mrca'             : 'maxhsp.mrca',
+           'taxid2name.sciname'    : 'maxhsp.sciname'}
+QUALIFIED = re.compile(r'\b(blastdatabase|mrca|taxid2name)\.(\w+)\b', re.IGNORECASE)
+
+
+# ==================
+# EXPORTED FUNCTIONS
+# ==================
+
+def is_materialized(cur):
+    return(misc.table_exists('maxhsp', cur, views=False))
+
+def is_fresh(cur):
+    '''
+    True if MaxHsp holds the best HSP of every pair of the report as it is
+    '''
+    if(not is_materialized(cur)):
+        return(False)
+    if(misc.fetch("SELECT 1 FROM MaxHspStale LIMIT 1", cur)):
+        return(False)
+    return(_state('generation', cur) == str(meta.taxonomy_generation(cur)))
+
+def invalidate(path, cur):
+    '''
+    Marks the (database, locus) pairs of a report file stale. Called before
+    the rows of a file are removed and again once it is loaded.
+    '''
+    if(not is_materialized(cur)):
+        return
+    misc.execute("""INSERT INTO MaxHspStale (database, locus)
+                    SELECT DISTINCT r.blastoutput_db, r.query_locus
+                    FROM LoadedQuery q JOIN BlastReport r
+                    ON r.blastoutput_db = q.database AND r.query_seqid = q.query_seqid
+                    WHERE q.path = ?""", cur, (path, ))
+
+def invalidate_keys(keys, cur):
+    '''
+    invalidate for rows loaded without a manifest path (from stdin), given
+    their (database, query_seqid) keys, once the rows are written
+    '''
+    if(not is_materialized(cur)):
+        return
+    misc.execute("""CREATE TEMP TABLE IF NOT EXISTS maxhsp_keys
+                    (database, query_seqid)""", cur)
+    misc.execute("DELETE FROM temp.maxhsp_keys", cur)
+    misc.insertmany(('database', 'query_seqid'), keys, 'temp.maxhsp_keys', cur)
+    misc.execute("""INSERT INTO MaxHspStale (database, locus)
+                    SELECT DISTINCT r.blastoutput_db, r.query_locus
+                    FROM temp.maxhsp_keys k JOIN BlastReport r
+                    ON r.blastoutput_db = k.database
+                    AND r.query_seqid = k.query_seqid""", cur)
+
+def refresh(cur, verbose=False):
+    '''
+    Finds the best HSP of the stale pairs again, or of all pairs if the
+    table is new. Pairs whose taxonomy changed since the last refresh (the
+    database was added or its taxid looked up, or the MRCA of its taxon and
+    the query taxon changed) are stale too. Nothing is done until the
+    taxonomy tables exist.
+    '''
+    if(not all(misc.table_exists(x, cur) for x in TAXONOMY)):
+        return
+    full = not is_materialized(cur)
+    if(full):
+        initialize.init_maxhsp(cur)
+    generation = meta.taxonomy_generation(cur)
+    columns = ('database', 'locus', 'seqid', 'hit', 'hsp', 'score', 'species',
+               'taxid', 'phylostratum', 'mrca', 'sciname')
+    if(full):
+        if(verbose):
+            print("Finding the best HSP of every database/query pair", file=sys.stderr)
+        cmd = misc.SELECT_BEST.format("blastreport r")
+        _copy_taxonomy(cur)
+    else:
+        if(_state('generation', cur) != str(generation)):
+            _invalidate_taxonomy(cur)
+        if(not misc.fetch("SELECT 1 FROM MaxHspStale LIMIT 1", cur)):
+            _set_state('generation', generation, cur)
+            cur.connection.commit()
+            return
+        # NULL loci are matched with IS
+        misc.execute("""DELETE FROM MaxHsp WHERE EXISTS (
+                            SELECT 1 FROM MaxHspStale s
+                            WHERE s.database = MaxHsp.database
+                            AND s.locus IS MaxHsp.locus)""", cur)
+        cmd = misc.SELECT_BEST.format(
+            """(SELECT DISTINCT database, locus FROM MaxHspStale) s
+               JOIN blastreport r ON r.blastoutput_db = s.database
+               AND r.query_locus IS s.locus""")
+    misc.execute("INSERT INTO MaxHsp ({}) {}".format(', '.join(columns), cmd), cur)
+    misc.execute("DELETE FROM MaxHspStale", cur)
+    _set_state('generation', generation, cur)
+    cur.connection.commit()
+
+def get_maxattr(fields, cur, condition=None):
+    '''
+    misc.get_maxattr read from MaxHsp, with the condition applied to the
+    best row of each pair. Returns None if the fields or condition use
+    columns of the taxonomy tables MaxHsp does not keep.
+    '''
+    fields = [_rename(x) for x in fields]
+    where = ''
+    if(condition):
+        condition = _rename(condition)
+        if(condition is None):
+            return(None)
+        where = "WHERE {}".format(condition)
+    if(None in fields):
+        return(None)
+    cmd = '''SELECT maxhsp.species, maxhsp.locus, maxhsp.score, {}
+             FROM MaxHsp maxhsp JOIN blastreport ON
+                 blastreport.blastoutput_db = maxhsp.database AND
+                 blastreport.query_seqid = maxhsp.seqid AND
+                 blastreport.hit_num = maxhsp.hit AND
+                 blastreport.hsp_num = maxhsp.hsp
+             {}
+             ORDER BY maxhsp.locus, maxhsp.phylostratum, maxhsp.mrca,
+                      maxhsp.database'''.format(', '.join(fields), where)
+    return(misc.fetch(cmd, cur))
+
+
+# =================
+# UTILITY FUNCTIONS
+# =================
+
+def _invalidate_taxonomy(cur):
+    '''
+    Marks stale the pairs of the databases whose row in BlastDatabase
+    changed, and the pairs whose (query taxon, database taxid) row of MRCA
+    changed, since the copies were taken. Then takes the copies again.
+    '''
+    databases = misc.CHANGED_ROWS.format(DATABASES['live'], DATABASES['kept'],
+                                         'database')
+    misc.execute("""INSERT INTO MaxHspStale (database, locus)
+                    SELECT DISTINCT r.blastoutput_db, r.query_locus
+                    FROM blastreport r
+                    WHERE r.blastoutput_db IN ({})""".format(databases), cur)
+    pairs = misc.CHANGED_ROWS.format(PAIRS['live'], PAIRS['kept'], 'taxid_1, taxid_2')
+    misc.execute("""INSERT INTO MaxHspStale (database, locus)
+                    SELECT DISTINCT r.blastoutput_db, r.query_locus
+                    FROM ({}) c
+                    JOIN blastdatabase d ON d.taxid = c.taxid_2
+                    JOIN blastreport r ON r.blastoutput_db = d.database
+                    AND r.query_taxon = c.taxid_1""".format(pairs), cur)
+    _copy_taxonomy(cur)
+
+def _copy_taxonomy(cur):
+    misc.execute("DELETE FROM MaxHspDatabase", cur)
+    misc.execute("INSERT INTO MaxHspDatabase " + DATABASES['live'], cur)
+    misc.execute("DELETE FROM MaxHspMRCA", cur)
+    misc.execute("INSERT INTO MaxHspMRCA " + PAIRS['live'], cur)
+
+def _state(name, cur):
+    value = misc.fetch("SELECT value FROM MaxHspState WHERE name = ?", cur, (name, ))
+    return(value[0][0] if value else None)
+
+def _set_state(name, value, cur):
+    misc.insert({'name': name, 'value': value}, 'MaxHspState', cur, replace=True)
+
+def _rename(text):
+    '''
+    Replaces the taxonomy columns in a field or condition by those of
+    MaxHsp, returns None if some are not kept
+    '''
+    missing = []
+    def rename(match):
+        name = match.group(0).lower()
+        if(name not in COLUMNS):
+            missing.append(name)
+            return(name)
+        return(COLUMNS[name])
+    text = QUALIFIED.sub(rename, text)
+    return(None if missing else text)
@@ -14,30 +14,33 @@ from   lib.lineage import Lineage, MRCA
 # EXPORTED FUNCTIONS
 # ==================
 
-def update_dbinfo(cur, deep=False, destroy=False, verbose=False):
+def update_dbinfo(cur, deep=False, destroy=False, verbose=False, report_curs=None):
+    # report_curs are the cursors holding BlastReport (the shards of a
+    # sharded database), by default cur
     if(not misc.table_exists('blastdatabase', cur) or destroy):
         initialize.init_blastdatabase(cur, verbose)
         deep = True
     if(deep):
         print("Retrieving database names from blastreport (this may take awhile)")
-        db = misc.get_fields('Blastoutput_db', 'blastreport', cur, is_distinct=True)
+        db = set()
+        for rcur in (report_curs or [cur]):
+            db.update(misc.get_fields('Blastoutput_db', 'blastreport', rcur,
+                                      is_distinct=True))
         for d in db:
             misc.insert({'database':d}, 'blastdatabase', cur)
 
+    # Only databases without a taxid need to be looked up
+    dbfiles = misc.fetch(
+        "select database, species from blastdatabase where taxid is null", cur)
+    if(deep or dbfiles):
+        touch_taxonomy(cur)
 
-    dbfiles = misc.get_fields('database', 'blastdatabase', cur, is_distinct=True)
-
-    for f in dbfiles:
-        ori = misc.get_fields(('species','taxid'), 'blastdatabase',
-                               cur, ident='database', value=f)[0]
-
-        if(ori[1] is not None): continue
-
-        if(ori[0] is None):
+    for f, species in dbfiles:
+        if(species is None):
             name = re.sub("\..*", "", f)
             name = re.sub("_", " ", name)
         else:
-            name = ori[0]
+            name = species
 
         taxid = entrez.sciname2taxid(name)
 
@@ -48,11 +51,20 @@ def update_dbinfo(cur, deep=False, destroy=False, verbose=False):
         misc.update({'species': name, 'taxid': taxid}, 'blastdatabase',
                     ('database', f), cur)
 
-def update_mrca(cur, sync=True, taxids=None, verbose=False):
+def update_mrca(cur, sync=True, taxids=None, verbose=False, only_new=False):
+    '''
+    Fills the MRCA and Taxid2Name tables for the given taxids and (if sync)
+    the taxids of all blast databases. With only_new, nothing is done unless
+    some of these taxids are missing from MRCA, and then only pairs
+    involving a missing taxid are written. Known lineages are then read from
+    the Lineage table rather than fetched again.
+    '''
     if(not misc.table_exists('mrca', cur)):
         initialize.init_mrca(cur, verbose)
     if(not misc.table_exists('Taxid2Name', cur)):
         initialize.init_taxid2name(cur, verbose)
+    if(not misc.table_exists('Lineage', cur)):
+        initialize.init_lineage(cur, verbose)
 
     taxid_in = set()
     if(taxids):
@@ -61,14 +73,28 @@ def update_mrca(cur, sync=True, taxids=None, verbose=False):
         db_taxids = misc.get_fields('taxid', 'blastdatabase', cur, is_distinct=True)
         taxid_in.update(db_taxids)
 
-    # Retrieve taxonomy xml file from entrez
-    lin = entrez.taxid2lineage(taxid_in)
+    if(only_new):
+        taxid_in.discard(None)
+        taxid_in = set(int(t) for t in taxid_in)
+        known = set(misc.get_fields('taxid_1', 'mrca', cur, is_distinct=True))
+        new = taxid_in - known
+        if(not new):
+            return
+        lin = _get_lineages(taxid_in, cur)
+    else:
+        # Retrieve taxonomy xml file from entrez
+        lin = entrez.taxid2lineage(taxid_in)
+        new = None
+        _store_lineages(lin, cur)
+
+    touch_taxonomy(cur)
 
     # Find mrca
     mrca = {} # A dict that holds mrca for pairs of taxids
     for k1 in lin:
         for k2 in lin:
-            mrca[(k1, k2)] = MRCA(k1, k2)
+            if(new is None or k1.taxid in new or k2.taxid in new):
+                mrca[(k1, k2)] = MRCA(k1, k2)
 
     # Update MRCA SQL database |taxid1|taxid2|mrca|phylostratum|
     for key in mrca:
@@ -88,6 +114,23 @@ def update_mrca(cur, sync=True, taxids=None, verbose=False):
         for pair in l.lineage:
             t2n_insert(*pair)
 
+def taxonomy_generation(cur):
+    '''
+    The taxonomy generation, moved on by every write to BlastDatabase, MRCA
+    or Taxid2Name. Tables built from these keep the generation they were
+    built at, which tells cheaply whether they are out of date.
+    '''
+    if(not misc.table_exists('taxonomystate', cur, views=False)):
+        return(0)
+    value = misc.fetch("SELECT value FROM TaxonomyState WHERE name = 'generation'", cur)
+    return(int(value[0][0]) if value else 0)
+
+def touch_taxonomy(cur):
+    if(not misc.table_exists('taxonomystate', cur, views=False)):
+        initialize.init_taxonomystate(cur)
+    misc.insert({'name': 'generation', 'value': taxonomy_generation(cur) + 1},
+                'TaxonomyState', cur, replace=True)
+
 def update_besthits(cur, con, verbose=False):
     if(not misc.table_exists('besthits', cur)):
         initialize.init_besthits(cur, verbose)
@@ -141,6 +184,38 @@ def update_besthits(cur, con, verbose=False):
 # UTILITY FUNCTIONS
 # =================
 
+def _get_lineages(taxids, cur):
+    '''
+    Returns Lineage objects for the taxids, reading those seen before from
+    the Lineage table and fetching the rest from entrez
+    '''
+    cmd = """
+        select
+            taxid,
+            (select min(sciname) from taxid2name where taxid = lineage.taxid),
+            ancestor,
+            (select min(sciname) from taxid2name where taxid = lineage.ancestor)
+        from lineage
+        order by taxid, depth"""
+    cached = {}
+    for taxid, sciname, ancestor, aname in misc.fetch(cmd, cur):
+        if(taxid not in cached):
+            cached[taxid] = Lineage(taxid, sciname, [])
+        cached[taxid].lineage.append((str(ancestor), aname))
+    lin = [cached[t] for t in taxids if t in cached]
+    missing = [t for t in taxids if t not in cached]
+    if(missing):
+        fetched = entrez.taxid2lineage(missing)
+        _store_lineages(fetched, cur)
+        lin += fetched
+    return(lin)
+
+def _store_lineages(lin, cur):
+    for l in lin:
+        misc.execute("delete from lineage where taxid = ?", cur, (l.taxid, ))
+        rows = [(l.taxid, i, int(pair[0])) for i, pair in enumerate(l.lineage)]
+        misc.insertmany(('taxid', 'depth', 'ancestor'), rows, 'Lineage', cur)
+
 def _set_taxid(name=None):
     qstr = "Please enter taxid (e.g. 3702): "
     taxid = input(qstr)
@@ -0,0 +1,200 @@
+#! /usr/bin/python3
+
+import sys
+
+import lib.initialize as initialize
+import lib.meta as meta
+import lib.sqlite_interface as misc
+
+# =========
+# CONSTANTS
+# =========
+
+# Criteria every 'update' keeps in Phylostrata (the default of query phylo)
+DEFAULT_CRITERIA = (('score', 100.0), )
+
+# The BlastDatabase and MRCA rows phylostrata depend on, as they are
+# ('live') and as copied by refresh into PhylostrataDatabase and
+# PhylostrataMRCA ('kept'). Queries without a qualifying hit take the
+# highest phylostratum of their taxon (SPECIES).
+DATABASES = {'live': "SELECT database, taxid FROM BlastDatabase",
+             'kept': "SELECT database, taxid FROM PhylostrataDatabase"}
+PAIRS = {'live': "SELECT taxid_1, taxid_2, phylostratum FROM MRCA",
+         'kept': "SELECT taxid_1, taxid_2, phylostratum FROM PhylostrataMRCA"}
+SPECIES = {'live': """SELECT taxid_1, max(phylostratum) AS phylostratum
+                      FROM MRCA GROUP BY taxid_1""",
+           'kept': """SELECT taxid_1, max(phylostratum) AS phylostratum
+                      FROM PhylostrataMRCA GROUP BY taxid_1"""}
+
+
+# ==================
+# EXPORTED FUNCTIONS
+# ==================
+
+def is_materialized(cur):
+    return(misc.table_exists('phylostratacriterion', cur, views=False))
+
+def criterion_key(criterion):
+    '''
+    Returns the (criterion, cutoff) pair a query phylo criterion is stored
+    under, anything but evalue is a score cutoff (as in misc.spec_batch)
+    '''
+    kind = 'evalue' if criterion[0] == 'evalue' else 'score'
+    return((kind, float(criterion[1])))
+
+def invalidate(path, cur):
+    '''
+    Marks the queries of a report file stale and moves the generation on.
+    Called before the rows of a file are removed and again once it is
+    loaded, so both the old and the new queries are recomputed.
+    '''
+    if(not is_materialized(cur)):
+        return
+    misc.execute("""INSERT OR IGNORE INTO PhylostrataStale (query_seqid)
+                    SELECT DISTINCT query_seqid FROM LoadedQuery WHERE path = ?""",
+                 cur, (path, ))
+    _set_state('generation', generation(cur) + 1, cur)
+
+def invalidate_keys(keys, cur):
+    '''
+    invalidate for rows loaded without a manifest path (from stdin), given
+    their (database, query_seqid) keys
+    '''
+    if(not is_materialized(cur)):
+        return
+    misc.insertmany(('query_seqid', ), [(k[1], ) for k in keys],
+                    'PhylostrataStale', cur, replace=True)
+    _set_state('generation', generation(cur) + 1, cur)
+
+def refresh(cur, criteria=(), verbose=False):
+    '''
+    Brings Phylostrata up to date for the criteria it keeps, adding the
+    given ones. Only stale queries are recomputed, which include those
+    whose taxonomy changed since the last refresh (a database they hit was
+    added or its taxid looked up, or the MRCA of their taxon and a database
+    taxon changed).
+    '''
+    taxonomy = meta.taxonomy_generation(cur)
+    if(not is_materialized(cur)):
+        initialize.init_phylostrata(cur)
+    elif(_state('taxonomy', cur) != str(taxonomy)):
+        _invalidate_taxonomy(cur)
+    for kind, cutoff in DEFAULT_CRITERIA + tuple(criterion_key(c) for c in criteria):
+        misc.execute("""INSERT OR IGNORE INTO PhylostrataCriterion
+                        (criterion, cutoff, generation) VALUES (?, ?, -1)""",
+                     cur, (kind, cutoff))
+
+    current = generation(cur)
+    everything = None
+    stale = misc.get_fields('query_seqid', 'PhylostrataStale', cur)
+
+    cmd = "SELECT criterion, cutoff, generation FROM PhylostrataCriterion"
+    for kind, cutoff, done in misc.fetch(cmd, cur):
+        if(done < 0):
+            if(everything is None):
+                everything = misc.get_fields('query_seqid', 'blastreport', cur,
+                                             is_distinct=True)
+            seqids = everything
+            misc.execute("DELETE FROM Phylostrata WHERE criterion = ? AND cutoff = ?",
+                         cur, (kind, cutoff))
+        elif(done == current):
+            continue
+        else:
+            seqids = stale
+            misc.execute_in("""DELETE FROM Phylostrata WHERE criterion = ?
+                               AND cutoff = ? AND query_seqid IN ({})""",
+                            seqids, cur, (kind, cutoff))
+        if(verbose):
+            print("Computing {} phylostrata ({} {})".format(len(seqids), kind, cutoff),
+                  file=sys.stderr)
+        ps = misc.spec_batch('seqid', seqids, (kind, cutoff), cur)
+        rows = [(kind, cutoff, seqid, species_ps if hit_ps is None else hit_ps)
+                for seqid, (hit_ps, found, species_ps) in ps.items() if found]
+        misc.insertmany(('criterion', 'cutoff', 'query_seqid', 'phylostratum'),
+                        rows, 'Phylostrata', cur, replace=True)
+        misc.execute("""UPDATE PhylostrataCriterion SET generation = ?
+                        WHERE criterion = ? AND cutoff = ?""",
+                     cur, (current, kind, cutoff))
+
+    misc.execute("DELETE FROM PhylostrataStale", cur)
+    _copy_taxonomy(cur)
+    _set_state('generation', current, cur)
+    _set_state('taxonomy', taxonomy, cur)
+    cur.connection.commit()
+
+def lookup(values, criterion, cur):
+    '''
+    Returns {seqid: phylostratum} for the seqids among values that are in
+    BlastReport, read from Phylostrata, or None if the table does not keep
+    the criterion or is out of date. Seqids the table lacks (loaded since
+    the last refresh) are computed from BlastReport.
+    '''
+    if(not is_materialized(cur)):
+        return(None)
+    kind, cutoff = criterion_key(criterion)
+    done = misc.fetch("""SELECT generation FROM PhylostrataCriterion
+                         WHERE criterion = ? AND cutoff = ?""", cur, (kind, cutoff))
+    if(not done or done[0][0] != generation(cur) or
+       _state('taxonomy', cur) != str(meta.taxonomy_generation(cur))):
+        return(None)
+    table = misc.temp_values(dict.fromkeys(values), cur, name='phylostrata_values')
+    cmd = """SELECT v.value, p.phylostratum FROM {} v
+             JOIN Phylostrata p ON p.query_seqid = v.value
+             WHERE p.criterion = ? AND p.cutoff = ?""".format(table)
+    out = dict(misc.fetch(cmd, cur, (kind, cutoff)))
+    missing = [x for x in values if x not in out]
+    if(missing):
+        ps = misc.spec_batch('seqid', missing, (kind, cutoff), cur)
+        out.update((seqid, species_ps if hit_ps is None else hit_ps)
+                   for seqid, (hit_ps, found, species_ps) in ps.items() if found)
+    return(out)
+
+def generation(cur):
+    value = _state('generation', cur)
+    return(0 if value is None else int(value))
+
+
+# =================
+# UTILITY FUNCTIONS
+# =================
+
+def _invalidate_taxonomy(cur):
+    '''
+    Marks stale the queries with hits in the databases whose row in
+    BlastDatabase changed, those of a taxon whose MRCA with the taxon of a
+    database they hit changed and those of a taxon whose highest
+    phylostratum changed, since the copies were taken. The generation
+    moves on if any query is stale.
+    '''
+    databases = misc.CHANGED_ROWS.format(DATABASES['live'], DATABASES['kept'],
+                                         'database')
+    misc.execute("""INSERT OR IGNORE INTO PhylostrataStale (query_seqid)
+                    SELECT DISTINCT r.query_seqid FROM blastreport r
+                    WHERE r.blastoutput_db IN ({})""".format(databases), cur)
+    pairs = misc.CHANGED_ROWS.format(PAIRS['live'], PAIRS['kept'], 'taxid_1, taxid_2')
+    misc.execute("""INSERT OR IGNORE INTO PhylostrataStale (query_seqid)
+                    SELECT DISTINCT r.query_seqid
+                    FROM ({}) c
+                    JOIN blastdatabase d ON d.taxid = c.taxid_2
+                    JOIN blastreport r ON r.blastoutput_db = d.database
+                    AND r.query_taxon = c.taxid_1""".format(pairs), cur)
+    species = misc.CHANGED_ROWS.format(SPECIES['live'], SPECIES['kept'], 'taxid_1')
+    misc.execute("""INSERT OR IGNORE INTO PhylostrataStale (query_seqid)
+                    SELECT DISTINCT r.query_seqid
+                    FROM ({}) c JOIN blastreport r
+                    ON r.query_taxon = c.taxid_1""".format(species), cur)
+    if(misc.fetch("SELECT 1 FROM PhylostrataStale LIMIT 1", cur)):
+        _set_state('generation', generation(cur) + 1, cur)
+
+def _copy_taxonomy(cur):
+    misc.execute("DELETE FROM PhylostrataDatabase", cur)
+    misc.execute("INSERT INTO PhylostrataDatabase " + DATABASES['live'], cur)
+    misc.execute("DELETE FROM PhylostrataMRCA", cur)
+    misc.execute("INSERT INTO PhylostrataMRCA " + PAIRS['live'], cur)
+
+def _state(name, cur):
+    value = misc.fetch("SELECT value FROM PhylostrataState WHERE name = ?", cur, (name, ))
+    return(value[0][0] if value else None)
+
+def _set_state(name, value, cur):
+    misc.insert({'name': name, 'value': value}, 'PhylostrataState', cur, replace=True)
@@ -1,11 +1,14 @@
 #! /usr/bin/python3
 
 import argparse
+import itertools
+import json
 import sys
 import csv
+import lib.maxhsp as maxhsp
+import lib.phylostrata as phylostrata
+import lib.shard as shard
 import lib.sqlite_interface as misc
-import re
-import pandas
 
 # =========
 # CONSTANTS
@@ -13,6 +16,19 @@ import pandas
 
 MISSING_DATA = 'MISSING'
 
+# query mat formats whose row and column labels are written beside the
+# data (or inside it, for npz), so a filename is required
+MAT_LABELLED = ('mtx', 'npy', 'npz')
+
+# Fields query maxattr reports unless --no-basic-fields is given
+MAXATTR_FIELDS = ('iteration_query_len', 'hit_len',
+                  'hit_def',
+                  'hsp_query_from', 'hsp_query_to',
+                  'hsp_hit_from', 'hsp_hit_to',
+                  'hsp_positive', 'hsp_bit_score',
+                  'mrca.phylostratum', 'mrca.mrca',
+                  'taxid2name.sciname')
+
 # ==================
 # EXPORTED FUNCTIONS
 # ==================
@@ -48,6 +64,15 @@ def parse(parent, *args, **kwargs):
         help="Search entire database",
         action='store_true', default=False)
 
+    # Parent parser for sub-commands that fan out over the shards of a
+    # sharded database
+    _workers = argparse.ArgumentParser(add_help=False)
+    _workers.add_argument(
+        '-w', '--workers',
+        metavar="INT",
+        help="Number of shards queried at once (default one per CPU)",
+        type=int)
+
     # Parent criterion class
     _criterion = argparse.ArgumentParser(add_help=False)
     _criterion.add_argument(
@@ -81,15 +106,25 @@ def parse(parent, *args, **kwargs):
     mat = sub.add_parser(
         'mat',
         help="Fetch a matrix",
-        parents=(args + (_identifiers, )))
+        parents=(args + (_identifiers, _workers)))
     mat.add_argument(
         '-l', '--filling',
         help="Fill matrix with this hsp value",
         default="hsp_bit_score")
     mat.add_argument(
         '-o', '--output',
-        help="Output csv file",
+        help="Output file (default stdout, required for mtx, npy and npz)",
         default=sys.stdout)
+    mat.add_argument(
+        '--format',
+        help="'csv' (dense), 'triplet' (query,database,score lines), 'mtx' "
+             "(Matrix Market), 'npy' (float32, memory-mappable) or 'npz' "
+             "(float32 with labels). Labels of mtx and npy go to "
+             "<output>.rows and <output>.cols, missing scores are NaN. "
+             "numpy (an optional dependency) is needed for all but csv and "
+             "triplet with --all.",
+        choices=['csv', 'triplet', 'mtx', 'npy', 'npz'],
+        default='csv')
 
     # Retrieve the clade specificity of a single locus
     # spec = sub.add_parser(
@@ -101,20 +136,21 @@ def parse(parent, *args, **kwargs):
     phylo = sub.add_parser(
         'phylo',
         help="Get phylostrata info",
-        parents=(args + (_identifiers, _criterion, kwargs['csv'])))
+        parents=(args + (_identifiers, _criterion, _workers, kwargs['csv'])))
     phylo.add_argument(
         '-p', '--pathway',
         help="Pathway or network name",
         default="Nameless")
     phylo.add_argument(
         '-t', '--outfmt',
-        help="Output format",
+        help="Output format, ndjson writes one JSON record per line",
+        choices=['csv', 'json', 'ndjson'],
         default='csv')
 
     maxattr = sub.add_parser(
         'maxattr',
         help="Get attributes of maximum scoring database/query pairs",
-        parents=(args + (kwargs['csv'], )))
+        parents=(args + (_workers, kwargs['csv'])))
     maxattr.add_argument(
         '--fields',
         nargs='+')
@@ -126,9 +162,10 @@ def parse(parent, *args, **kwargs):
         default=True)
     maxattr.add_argument(
         '--condition',
-        help="Condition upon which to keep")
+        help="Condition upon which to keep (applied to the best row of each "
+             "database/query pair)")
 
-    parser.set_defaults(func=_dispatch)
+    parser.set_defaults(func=_dispatch, readonly=True)
 
 
 # =================
@@ -136,6 +173,8 @@ def parse(parent, *args, **kwargs):
 # =================
 
 def _dispatch(args, cur):
+    # Report tables of a sharded database are read through shard.fan_out
+    args.shards = shard.ShardSet(cur, args.sqldb) if shard.is_sharded(cur) else None
     call = {'raw': _fetch_and_print,
             'mat': _get_mat,
             'phylo': _phylo,
@@ -144,21 +183,25 @@ def _dispatch(args, cur):
     call[args.query_function](args, cur)
 
 def _phylo(args, cur):
+    # Records are written as they are produced
     qdat = _get_query_data(args, cur)
     if(args.outfmt == 'json'):
         _phylo_json(qdat, args.pathway)
-    elif(args.outfmt == 'csv'):
-        _phylo_csv(qdat, args.delimiter)
+    elif(args.outfmt == 'ndjson'):
+        _phylo_ndjson(qdat)
     else:
-        print("Unrecognized format '{}', dying".format(args.outfmt), file=sys.stderr)
+        _phylo_csv(qdat, args.delimiter)
 
 def _fetch_and_print(args, cur):
-    rows = misc.fetch(args.sqlcmd, cur)
-    if args.header:
-        header = [x[0] for x in cur.description]
-        print(','.join(header))
-    for row in rows:
-        print((args.delimiter).join(map(str, row)))
+    rows = misc.stream(args.sqlcmd, cur)
+    writer = csv.writer(sys.stdout, delimiter=args.delimiter, lineterminator='\n')
+    # The statement only runs (and sets the description) on the first next()
+    first = next(rows, None)
+    if args.header and cur.description:
+        writer.writerow([x[0] for x in cur.description])
+    if first is not None:
+        writer.writerow(first)
+        writer.writerows(rows)
 
 def _get_mat(args, cur):
     dbs = misc.get_db(cur)
@@ -168,6 +211,15 @@ def _get_mat(args, cur):
     else:
         act = 'max'
 
+    # A return value of none implies an iteration with no hits, this
+    # corresponds to a high evalue or a 0 score
+    fill = 99 if args.filling == 'hsp_evalue' else 0
+
+    if(args.format in MAT_LABELLED and not isinstance(args.output, str)):
+        print("--format {} writes binary data and label files, give a filename "
+              "with -o".format(args.format), file=sys.stderr)
+        sys.exit(1)
+
     if args.all:
         d = {
             'q':'query_seqid',
@@ -175,10 +227,30 @@ def _get_mat(args, cur):
             'a':act,
             'f':args.filling,
             't':'blastreport',
-            'c':"and collection = '{}'".format(args.col) if args.col else ""}
+            'c':"where collection = ?" if args.col else ""}
         cmd = "select {q}, {d}, {a}({f}) from {t} {c} group by {q},{d}".format(**d)
-        for row in misc.fetch(cmd, cur):
-            print(','.join(map(str, row)))
+        params = (args.col, ) if args.col else ()
+        if(args.shards is None):
+            rows = misc.stream(cmd, cur, params)
+        else:
+            parts = shard.fan_out(args.shards, misc.fetch, (cmd, ), {'params': params},
+                                  workers=args.workers)
+            if(args.shards.shard_by == 'database'):
+                # Each (query, database) pair lies in one shard
+                rows = itertools.chain.from_iterable(parts)
+            else:
+                rows = _merge_scores(parts, act)
+        if(args.format in ('csv', 'triplet')):
+            # The rows are the triplets already, once scores of None are
+            # filled as in _collect
+            fill = float(fill)
+            rows = ((q, db, fill if x is None else x) for q, db, x in rows)
+            out = _open_output(args.output)
+            csv.writer(out, lineterminator='\n').writerows(rows)
+            if(out is not sys.stdout):
+                out.close()
+            return
+        queries = None
 
     else:
         args.identifier = 'query_{}'.format(args.identifier)
@@ -189,61 +261,212 @@ def _get_mat(args, cur):
         for x in queries:
             assert isinstance(x, str), "Found {} expected string".format(str(type(x)))
 
-        mat = pandas.DataFrame(index=queries, columns=dbs)
-
         d = {'d':'blastoutput_db',
-            'a':act,
-            'f':args.filling,
-            't':'blastreport',
-            'i':args.identifier,
-            'c':"and collection = '{}'".format(args.col) if args.col else "",
-            'v':'{}'}
-        cmd = "select {d}, {a}({f}) from {t} where {i} = '{v}' {c} group by {d}".format(**d)
-
-        for q in queries:
-            vals = misc.fetch(cmd.format(q), cur)
-            # A return value of none implies an iteration with no hits, this
-            # corresponds to a high evalue or a 0 score
-            if(args.filling == 'hsp_evalue'):
-                vals = [(x[0], 99) if x[1] is None else x for x in vals]
-            else:
-                vals = [(x[0], 0) if x[1] is None else x for x in vals]
-            for pair in vals:
-                mat.at[q, pair[0]] = pair[1]
-
-        # Drop empty columns (databases outside collection)
-        mat = mat.dropna(axis=1, how='all')
-
-        # Write output csv file
-        mat.to_csv(args.output)
+             'a':act,
+             'f':args.filling,
+             'i':args.identifier,
+             'c':"and r.collection = ?" if args.col else ""}
+        # One grouped join of the report against the identifiers, which are
+        # loaded into a temporary table
+        cmd = '''select v.value, r.{d}, {a}(r.{f})
+                 from {{}} v join blastreport r on r.{i} = v.value {c}
+                 group by v.value, r.{d}'''.format(**d)
+        params = (args.col, ) if args.col else ()
+
+        if(args.shards is None):
+            rows = _mat_rows(cmd, queries, params, cur=cur, stream=True)
+        else:
+            parts = shard.fan_out(args.shards, _mat_rows, (cmd, queries, params),
+                                  workers=args.workers)
+            rows = _merge_scores(parts, act)
+
+    dtype = 'float32' if args.format in ('npy', 'npz') else 'float64'
+    labels, columns, qi, di, vals = _collect(rows, queries, sorted(dbs), fill, dtype)
+    if(args.format == 'csv'):
+        out = _open_output(args.output)
+        _write_mat(out, queries, columns, _dense(labels, columns, qi, di, vals))
+    elif(args.format == 'triplet'):
+        out = _open_output(args.output)
+        writer = csv.writer(out, lineterminator='\n')
+        for i, j, v in zip(qi.tolist(), di.tolist(), vals.tolist()):
+            writer.writerow((labels[i], columns[j], repr(v)))
+    elif(args.format == 'mtx'):
+        out = _open_output(args.output)
+        _write_mtx(out, labels, columns, qi, di, vals)
+    elif(args.format == 'npy'):
+        numpy = _numpy()
+        out = open(args.output, 'wb')
+        numpy.save(out, _dense(labels, columns, qi, di, vals))
+    else:
+        numpy = _numpy()
+        out = open(args.output, 'wb')
+        numpy.savez(out, matrix=_dense(labels, columns, qi, di, vals),
+                    rows=numpy.array(labels, dtype=str),
+                    columns=numpy.array(columns, dtype=str))
+    if(out is not sys.stdout):
+        out.close()
+    if(args.format in ('mtx', 'npy')):
+        _write_labels(args.output + '.rows', labels)
+        _write_labels(args.output + '.cols', columns)
+
+def _mat_rows(cmd, queries, params=(), cur=None, stream=False):
+    '''
+    Runs a mat statement, whose {} stands for the table of query
+    identifiers, returning (query, database, score) rows
+    '''
+    table = misc.temp_values(sorted(set(queries)), cur, name='mat_queries')
+    if(stream):
+        return(misc.stream(cmd.format(table), cur, params))
+    return(misc.fetch(cmd.format(table), cur, params))
+
+def _collect(rows, queries, dbs, fill, dtype='float64'):
+    '''
+    Reads (query, database, score) rows, in chunks, into coordinate arrays.
+    Rows are the distinct queries (in input order, or in order of
+    appearance if queries is None), columns the databases that have a
+    score. Scores of None become fill. Returns (row labels, column labels,
+    row indices, column indices, values).
+    '''
+    numpy = _numpy()
+
+    qindex = {q: i for i, q in enumerate(dict.fromkeys(queries or ()))}
+    dindex = {db: i for i, db in enumerate(dbs)}
+    qi, di, vals = [], [], []
+    rows = iter(rows)
+    while(True):
+        chunk = list(itertools.islice(rows, misc.STREAM_ROWS))
+        if(not chunk):
+            break
+        qs, ds, vs = zip(*chunk)
+        if(queries is None):
+            qi.append(numpy.array([qindex.setdefault(q, len(qindex)) for q in qs]))
+        else:
+            qi.append(numpy.array([qindex[q] for q in qs]))
+        # Databases missing from BlastDatabase are added as new columns
+        di.append(numpy.array([dindex.setdefault(db, len(dindex)) for db in ds]))
+        vals.append(numpy.array([fill if v is None else v for v in vs], dtype=dtype))
+    empty = numpy.array([], dtype=int)
+    qi = numpy.concatenate(qi) if qi else empty
+    di = numpy.concatenate(di) if di else empty
+    vals = numpy.concatenate(vals) if vals else numpy.array([], dtype=dtype)
+
+    # Drop databases without any score, renumbering the others
+    keep = numpy.bincount(di, minlength=len(dindex)) > 0
+    di = (numpy.cumsum(keep) - 1)[di]
+    columns = [db for db, i in sorted(dindex.items(), key=lambda x: x[1]) if keep[i]]
+    return(list(qindex), columns, qi, di, vals)
+
+def _numpy():
+    '''
+    Imports numpy, an optional dependency only query mat uses. Imported
+    here, it takes longer to load than most queries take to run.
+    '''
+    try:
+        import numpy
+    except ImportError:
+        print("query mat needs numpy (but for csv and triplet with --all), "
+              "install it with 'pip install numpy'", file=sys.stderr)
+        sys.exit(1)
+    return(numpy)
+
+def _dense(labels, columns, qi, di, vals):
+    '''
+    The matrix of _collect coordinates, NaN where there is no score
+    '''
+    numpy = _numpy()
+    mat = numpy.full((len(labels), len(columns)), numpy.nan, dtype=vals.dtype)
+    mat[qi, di] = vals
+    return(mat)
+
+def _write_mat(out, queries, columns, mat):
+    '''
+    Writes the matrix as csv, a row per input query (in input order) and
+    empty cells for missing scores
+    '''
+    qindex = {q: i for i, q in enumerate(dict.fromkeys(queries))}
+    writer = csv.writer(out, lineterminator='\n')
+    writer.writerow([''] + columns)
+    for q in queries:
+        writer.writerow([q] + ['' if x != x else repr(x) for x in mat[qindex[q]].tolist()])
+
+def _write_mtx(out, labels, columns, qi, di, vals):
+    '''
+    Writes the scores in Matrix Market coordinate format (1-based indices),
+    cells without a score are left out
+    '''
+    out.write('%%MatrixMarket matrix coordinate real general\n')
+    out.write('% rows: queries, columns: databases (labels in .rows and .cols)\n')
+    out.write('{} {} {}\n'.format(len(labels), len(columns), len(vals)))
+    for i, j, v in zip(qi.tolist(), di.tolist(), vals.tolist()):
+        out.write('{} {} {!r}\n'.format(i + 1, j + 1, v))
+
+def _write_labels(filename, labels):
+    with open(filename, 'w') as f:
+        for label in labels:
+            f.write('{}\n'.format(label))
+
+def _open_output(output):
+    if(isinstance(output, str)):
+        return(open(output, 'w', newline=''))
+    return(output)
+
+def _merge_scores(parts, act):
+    '''
+    Merges (query, database, score) rows from several shards, keeping the
+    best score of a pair found in more than one
+    '''
+    best = {}
+    pick = min if act == 'min' else max
+    for rows in parts:
+        for q, db, val in rows:
+            old = best.get((q, db))
+            if(old is None):
+                best[(q, db)] = val
+            elif(val is not None):
+                best[(q, db)] = pick(old, val)
+    return([k + (v, ) for k, v in best.items()])
 
 def _phylo_json(qdat, pathway):
-    # Write output in JSON format
-    out = '{\n"Pathway":"' + pathway + '",\n'
-    out += '"Protein":\n\t[\n\t\t{\n'
-    gb_dat = []
+    # Write output in JSON format, all values as strings
+    out = sys.stdout
+    dumps = lambda x: json.dumps(x, ensure_ascii=False)
+    out.write('{\n"Pathway":' + dumps(pathway) + ',\n"Protein":\n\t[\n')
+    sep = ''
     for q in qdat:
-        d = []
-        for field, value in q.items():
-            d.append('\t\t\t"{}":"{}"'.format(field, value))
-        gb_dat.append(',\n'.join(d) + "\n\t\t}")
-    out += ",\n\t\t{\n".join(gb_dat) + "\n"
-    out += "\t]\n}"
-    # Remove sinlge quotes
-    out = re.sub("'", "", out)
-    print(out)
+        fields = ['\t\t\t{}:{}'.format(dumps(k), dumps(str(v))) for k, v in q.items()]
+        out.write(sep + '\t\t{\n' + ',\n'.join(fields) + '\n\t\t}')
+        sep = ',\n'
+    out.write('\n\t]\n}\n')
+
+def _phylo_ndjson(qdat):
+    # One JSON object per line, values keep their types (null for None)
+    out = sys.stdout
+    for q in qdat:
+        out.write(json.dumps(q, ensure_ascii=False) + '\n')
 
 def _phylo_csv(qdat, delimiter):
-    fields = qdat[0].keys()
-    print('{}'.format(delimiter).join(fields))
+    out = sys.stdout
+    fields = None
     for q in qdat:
-        print('{}'.format(delimiter).join([str(q[y]) for y in fields]))
+        if(fields is None):
+            fields = list(q.keys())
+            out.write(delimiter.join(fields) + '\n')
+        out.write(delimiter.join([str(q[y]) for y in fields]) + '\n')
 
 def _read_single_column(filename):
     with open(filename) as f:
-        dat = f.readlines()
-    dat = [re.sub("^\s*['\"]?\s*|\s*['\"]?\s*,?\s*$", "", x) for x in dat]
-    return(dat)
+        return([_clean_identifier(x) for x in f])
+
+def _clean_identifier(line):
+    # Strips surrounding space, one pair of quotes and a trailing comma
+    x = line.strip()
+    if(x.endswith(',')):
+        x = x[:-1].rstrip()
+    if(x.endswith(('"', "'"))):
+        x = x[:-1].rstrip()
+    if(x.startswith(('"', "'"))):
+        x = x[1:].lstrip()
+    return(x)
 
 def _get_identifiers(args, cur):
     q = []
@@ -251,43 +474,131 @@ def _get_identifiers(args, cur):
         q += args.from_list
     if(args.from_file):
         q += _read_single_column(args.from_file)
-    if(args.col):
-        q += misc.get_fields(args.identifier, 'blastreport', cur,
+    # phylo passes the bare identifier (seqid), mat the column (query_seqid)
+    column = misc._ident2field(args.identifier)
+    if(args.col and args.shards is None):
+        q += misc.get_fields(column, 'blastreport', cur,
                              ident='collection', value=args.col, is_distinct=True)
+    elif(args.col):
+        parts = shard.fan_out(args.shards, misc.get_fields,
+                              (column, 'blastreport'),
+                              {'ident': 'collection', 'value': args.col,
+                               'is_distinct': True}, workers=args.workers)
+        seen = set()
+        for part in parts:
+            q += [x for x in part if not (x in seen or seen.add(x))]
     return(q)
 
 def _get_query_data(args, cur):
+    # Yields a record per identifier, in input order
     ids = _get_identifiers(args, cur)
-    qdat = []
+    if(args.shards is not None):
+        yield from _get_query_data_sharded(args, ids)
+        return
     ps = _spec(args.identifier, ids, args.criterion, cur)
+    info = misc.get_query_info_batch(args.identifier, ids, cur)
     for i in ids:
-        q = misc.get_query_info(args.identifier, i, cur)[0]
+        # Copied, an identifier may be listed more than once
+        q = dict(info[i])
         if(args.criterion):
             q['phylostratum'] = ps[i]
-        qdat.append(q)
-    return(qdat)
+        yield q
+
+def _get_query_data_sharded(args, ids):
+    '''
+    Runs the spec and query info lookups of _get_query_data on every shard
+    and merges them: the lowest phylostratum with a qualifying hit in any
+    shard, else that of the query species
+    '''
+    parts = shard.fan_out(args.shards, _shard_query_data,
+                          (args.identifier, ids, args.criterion), workers=args.workers)
+    # Missing identifiers stop the run before anything is written
+    for i in ids:
+        if(all(part[i][0] is None for part in parts)):
+            _not_found(args.identifier, i)
+    for i in ids:
+        found = [part[i] for part in parts if part[i][0] is not None]
+        q = dict(found[0][0])
+        if(args.criterion):
+            hit_ps = [x[1] for x in found if x[1] is not None]
+            q['phylostratum'] = min(hit_ps) if hit_ps else \
+                                max((x[2] for x in found if x[2] is not None),
+                                    default=None)
+        yield q
+
+def _shard_query_data(identifier, ids, criterion, cur):
+    # {id: (query info or None if absent, hit phylostratum, species phylostratum)}
+    out = {}
+    ps = misc.spec_batch(identifier, ids, criterion, cur)
+    info = misc.get_query_info_batch(identifier, ids, cur)
+    for i in ids:
+        hit_ps, found, species_ps = ps[i]
+        out[i] = (info.get(i), hit_ps, species_ps)
+    return(out)
 
 def _get_maxattr(args, cur):
-    fields = set()
-    if(args.fields):
-        fields = args.fields
+    fields = list(args.fields or [])
     if(args.basic_fields):
-        fields.update(['iteration_query_len', 'hit_len',
-                       'hit_def',
-                       'hsp_query_from', 'hsp_query_to',
-                       'hsp_hit_from', 'hsp_hit_to',
-                       'hsp_positive', 'hsp_bit_score',
-                       'mrca.phylostratum', 'mrca.mrca',
-                       'taxid2name.sciname'])
-    raw_results = misc.get_maxattr(fields, cur, condition=args.condition)
+        fields += [x for x in MAXATTR_FIELDS if x not in fields]
+    if(args.shards is None):
+        # The table kept at load and update, unless it is out of date
+        raw_results = None
+        if(maxhsp.is_fresh(cur)):
+            raw_results = maxhsp.get_maxattr(fields, cur, condition=args.condition)
+        if(raw_results is None):
+            raw_results = misc.get_maxattr(fields, cur, condition=args.condition)
+    else:
+        parts = shard.fan_out(args.shards, misc.get_maxattr, (fields, ),
+                              {'condition': args.condition, 'sort_keys': True},
+                              workers=args.workers)
+        raw_results = _merge_maxattr(parts)
     writer = csv.writer(sys.stdout, delimiter=args.delimiter,
                         quoting=csv.QUOTE_MINIMAL)
     writer.writerow(['database','query'] + list(fields))
     for row in raw_results:
         writer.writerow(row[:2] + row[3:])
 
+def _merge_maxattr(parts):
+    '''
+    Merges get_maxattr(..., sort_keys=True) rows from several shards into
+    the order of a single query, dropping the sort keys. A pair found in
+    several shards keeps its best row, ties going to the lowest (seqid,
+    hit, hsp) as in misc.SELECT_BEST.
+    '''
+    # SQLite sorts NULL first (and so last when descending)
+    nulls_first = lambda x: (x is not None, x)
+    rank = lambda r: ((r[2] is None, -(r[2] or 0)), r[-3], r[-2], r[-1])
+    best = {}
+    for rows in parts:
+        for row in rows:
+            key = (row[-4], row[1])
+            if(key not in best or rank(row) < rank(best[key])):
+                best[key] = row
+    rows = sorted(best.values(), key=lambda r: (nulls_first(r[1]), nulls_first(r[-6]),
+                                                nulls_first(r[-5]), r[-4]))
+    return([row[:-6] for row in rows])
+
 def _spec(identifier, values, criterion, cur):
     out = {}
-    for val in values:
-        out[val] = misc.spec(identifier, val, criterion, cur)
+    if(misc._ident2field(identifier) == 'query_seqid'):
+        # Read from the table kept by 'update', if it is up to date
+        known = phylostrata.lookup(values, criterion, cur)
+        if(known is not None):
+            for val in values:
+                if(val not in known):
+                    _not_found(identifier, val)
+                out[val] = known[val]
+            return(out)
+    for val, (hit_ps, found, species_ps) in misc.spec_batch(
+            identifier, values, criterion, cur).items():
+        # A protein without qualifying hits is specific to the query species
+        if(not found):
+            _not_found(identifier, val)
+        out[val] = species_ps if hit_ps is None else hit_ps
     return(out)
+
+def _not_found(identifier, value):
+    print("Column {} does not contain value {}".format(
+          misc._ident2field(identifier), value),
+          " dying painfully...", file=sys.stderr)
+    sys.exit(1)
@@ -0,0 +1,171 @@
+#! /usr/bin/python3
+
+import multiprocessing
+import os
+import re
+import urllib.request
+
+import lib.initialize as initialize
+import lib.sqlite_interface as misc
+
+# =========
+# CONSTANTS
+# =========
+
+# Row values shards can be keyed on
+SHARD_BY = ('database', 'collection')
+
+# Schema name of the catalog in shard connections. Tables missing from the
+# shard (MRCA, BlastDatabase, LoadedQuery, ...) are found there, so the
+# usual statements run unchanged on a shard.
+CATALOG_SCHEMA = 'catalog'
+
+
+# ==================
+# EXPORTED FUNCTIONS
+# ==================
+
+def is_sharded(cur):
+    return(misc.table_exists('shard', cur, views=False))
+
+def init_shards(cur, shard_by, normalized):
+    initialize.init_shard(cur)
+    misc.insertmany(('name', 'value'),
+                    [('shard_by', shard_by), ('normalized', str(int(normalized)))],
+                    'ShardSetting', cur)
+    cur.connection.commit()
+
+def connect(path, catalog, readonly=False):
+    '''
+    Opens a shard with its catalog attached
+    '''
+    con = misc.open_db(path, readonly=readonly)
+    if(readonly):
+        catalog = 'file:{}?mode=ro'.format(urllib.request.pathname2url(catalog))
+    con.execute('ATTACH DATABASE ? AS {}'.format(CATALOG_SCHEMA), (catalog, ))
+    return(con)
+
+def fan_out(shards, func, args=(), kwargs=None, workers=None):
+    '''
+    Calls func(*args, cur=cur, **kwargs) on every shard, each in a worker
+    process reading the shard (catalog attached) from a read-only snapshot.
+    Returns the results in shard order. func must be a module level
+    function.
+    '''
+    jobs = [(shards.path(key), shards.catalog, func, args, kwargs or {})
+            for key in shards.keys()]
+    workers = min(workers or os.cpu_count() or 1, len(jobs))
+    if(workers <= 1):
+        return([_fan_out_worker(job) for job in jobs])
+    with multiprocessing.Pool(workers) as pool:
+        return(pool.map(_fan_out_worker, jobs))
+
+
+class ShardSet:
+    '''
+    The shard files of a catalog database. The catalog keeps the databases,
+    taxonomy and manifest, each shard the report tables for one value of
+    the shard key: the BLAST database searched or the collection.
+    '''
+    def __init__(self, cur, catalog):
+        self.cur = cur
+        self.catalog = os.path.abspath(catalog)
+        settings = dict(misc.fetch("SELECT name, value FROM ShardSetting", cur))
+        self.shard_by = settings['shard_by']
+        self.normalized = settings['normalized'] == '1'
+        self.paths = dict(misc.fetch("SELECT key, path FROM Shard ORDER BY key", cur))
+        # The collection rows are routed to when sharding by collection
+        self.collection = None
+        # Called with the cursor of each shard opened for writing
+        self.setup = None
+        self.curs = {}
+        self.key_index = {}
+
+    def keys(self):
+        return(list(self.paths))
+
+    def path(self, key):
+        return(os.path.join(os.path.dirname(self.catalog), self.paths[key]))
+
+    def cursor(self, key):
+        '''
+        Returns a writable cursor on the shard for key, creating the shard
+        the first time
+        '''
+        try:
+            return(self.curs[key])
+        except KeyError:
+            pass
+        if(key not in self.paths):
+            directory = os.path.basename(self.catalog) + '.shards'
+            os.makedirs(os.path.join(os.path.dirname(self.catalog), directory),
+                        exist_ok=True)
+            path = os.path.join(directory, _filename(key, self.paths.values()))
+            misc.insert({'key': key, 'path': path}, 'Shard', self.cur)
+            self.cur.connection.commit()
+            self.paths[key] = path
+        cur = connect(self.path(key), self.catalog).cursor()
+        if(self.setup is not None):
+            self.setup(cur)
+        self.curs[key] = cur
+        return(cur)
+
+    def cursors(self):
+        '''
+        Writable cursors on all shards, as (key, cursor) pairs
+        '''
+        return([(key, self.cursor(key)) for key in self.keys()])
+
+    def key(self, col, row):
+        '''
+        Returns the shard key of a row with columns col
+        '''
+        if(self.shard_by == 'collection'):
+            return(self.collection)
+        try:
+            i = self.key_index[col]
+        except KeyError:
+            i = self.key_index[col] = [x.lower() for x in col].index('blastoutput_db')
+        return(row[i])
+
+    def partition(self, col, rows):
+        '''
+        Splits rows by shard, returns (key, rows) pairs
+        '''
+        parts = {}
+        for row in rows:
+            key = self.key(col, row)
+            try:
+                parts[key].append(row)
+            except KeyError:
+                parts[key] = [row]
+        return(parts.items())
+
+    def commit(self):
+        for cur in self.curs.values():
+            cur.connection.commit()
+
+
+# =================
+# UTILITY FUNCTIONS
+# =================
+
+def _fan_out_worker(job):
+    path, catalog, func, args, kwargs = job
+    con = connect(path, catalog, readonly=True)
+    try:
+        cur = con.cursor()
+        misc.snapshot(cur)
+        return(func(*args, cur=cur, **kwargs))
+    finally:
+        con.close()
+
+def _filename(key, taken):
+    base = re.sub(r'[^\w.-]+', '_', str(key)).strip('._') or 'shard'
+    base = re.sub(r'\.(faa|fna|fa|fasta)$', '', base)
+    taken = set(os.path.basename(x) for x in taken)
+    name, i = base + '.db', 1
+    while(name in taken):
+        i += 1
+        name = '{}_{}.db'.format(base, i)
+    return(name)
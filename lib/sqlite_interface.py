@@ -3,7 +3,104 @@
 import sqlite3 as sql
 import sys
 import argparse
+import functools
+import os
+import time
 import traceback
+import urllib.request
+import zlib
+
+import lib.sqlprofile as sqlprofile
+
+# =========
+# CONSTANTS
+# =========
+
+ALIGNMENT_PARTS = ('qseq', 'hseq', 'midline')
+
+# BlastReport columns returned by get_query_info_batch, with their output names
+QUERY_INFO_FIELDS = (('query_seqid', 'seqid'),
+                     ('query_locus', 'locus'),
+                     ('query_taxon', 'taxon'),
+                     ('query_gi', 'gi'),
+                     ('query_gb', 'gb'),
+                     ('iteration_query_len', 'length'))
+
+# The phylostratum of each identifier of temporary table {1}, matched against
+# BlastReport column {0}, where {2} tells whether a hit qualifies. Run by
+# spec_batch and explained by 'index check'.
+SPEC_BATCH = """
+    with report as (
+        -- whether each (identifier, database) pair has a qualifying hit
+        select v.value as value, r.blastoutput_db as db,
+               min(r.query_taxon) as taxon, max({2}) as hit
+            from {1} v join blastreport r on r.{0} = v.value
+            group by v.value, r.blastoutput_db
+    ),
+    query as (
+        select value, min(taxon) as taxon from report group by value
+    ),
+    hit as (
+        select q.value as value, q.taxon as taxon, min(m.phylostratum) as ps
+            from query q
+            left join report p on p.value = q.value and p.hit
+            left join blastdatabase b on b.database = p.db
+            left join mrca m on m.taxid_1 = q.taxon and m.taxid_2 = b.taxid
+            group by q.value
+    )
+    select value, ps,
+        case when ps is null then
+            (select max(phylostratum) from mrca where taxid_1 = hit.taxon)
+        end
+        from hit
+    ;"""
+
+# Finds the best HSP of each (database, locus) pair of the report, {} is
+# the restriction to some pairs. Ties go to the lowest (seqid, hit, hsp).
+# Run by get_maxattr and to fill the MaxHsp table.
+SELECT_BEST = '''
+    SELECT database, locus, seqid, hit, hsp, score, species, taxid,
+           phylostratum, mrca, sciname FROM (
+        SELECT r.blastoutput_db AS database, r.query_locus AS locus,
+               r.query_seqid AS seqid, r.hit_num AS hit, r.hsp_num AS hsp,
+               r.hsp_bit_score AS score, d.species AS species, d.taxid AS taxid,
+               m.phylostratum AS phylostratum, m.mrca AS mrca, t.sciname AS sciname,
+               row_number() OVER (
+                   PARTITION BY r.blastoutput_db, r.query_locus
+                   ORDER BY r.hsp_bit_score DESC, r.query_seqid, r.hit_num,
+                            r.hsp_num, t.sciname) AS n
+        FROM {}
+        JOIN blastdatabase d ON r.blastoutput_db = d.database
+        JOIN mrca m ON r.query_taxon = m.taxid_1 AND d.taxid = m.taxid_2
+        JOIN taxid2name t ON m.mrca = t.taxid)
+    WHERE n = 1'''
+
+# The {2} columns of the rows one of the queries {0} and {1} returns and the
+# other does not, to tell what changed in a table since a copy was kept
+CHANGED_ROWS = """
+    SELECT {2} FROM ({0} EXCEPT {1})
+    UNION
+    SELECT {2} FROM ({1} EXCEPT {0})"""
+
+# Prepared statements kept per connection (the sqlite3 default is 128)
+STATEMENT_CACHE = 512
+
+# Values bound per IN list (SQLite allows at least 999 variables). Longer
+# lists are matched against a temporary table instead.
+MAX_IN_VALUES = 500
+
+# WAL pages after which a commit checkpoints on its own (the SQLite default
+# is 1000). The writer also checkpoints after each input file.
+CHECKPOINT_PAGES = 10000
+
+# Seconds a connection waits on a lock before giving up
+BUSY_TIMEOUT = 30
+
+# Rows taken from the cursor at a time by stream
+STREAM_ROWS = 1000
+
+# The SQLProfile statements are recorded in, if profiling is on
+_profile = None
 
 # ==============
 # BASE FUNCTIONS
@@ -20,7 +117,12 @@ def insert(dic, table, cur, replace=False):
                       ")"))
     try:
         # ONLY values can be substituted for '?', NOT table or column names
-        cur.execute(cmd, row)
+        if(_profile is None):
+            cur.execute(cmd, row)
+        else:
+            start = time.perf_counter()
+            cur.execute(cmd, row)
+            _profile.record(cmd, time.perf_counter() - start, cur.rowcount)
     except Exception as e:
         _sql_err(e, cmd)
 
@@ -33,75 +135,220 @@ def insertmany(col, rows, table, cur, replace=False):
                       ")"))
     try:
         # ONLY values can be substituted for '?', NOT table or column names
-        cur.executemany(cmd, rows)
+        if(_profile is None):
+            cur.executemany(cmd, rows)
+        else:
+            start = time.perf_counter()
+            cur.executemany(cmd, rows)
+            _profile.record(cmd, time.perf_counter() - start, cur.rowcount)
     except Exception as e:
         print(rows)
         _sql_err(e, cmd)
 
 def update(dic, table, cond, cur):
-    sets = []
-    if(isinstance(cond[1], str)):
-        condition = "where {} = '{}'".format(*cond)
-    else:
-        condition = "where {} in ({})".format(cond[0], _quote(', '.join(cond[1])))
-    for col, val in dic.items():
-        val = _quote(val)
-        sets.append("{} = {}".format(col, val))
-    cmd = ' '.join(("UPDATE {} SET".format(table),
-                   ', '.join(sets), ' ', condition))
+    field, value = cond
+    cmd = "UPDATE {} SET {} WHERE {} IN ({{}})".format(
+          table, ', '.join("{} = ?".format(col) for col in dic), field)
+    execute_in(cmd, _as_list(value), cur, params=tuple(dic.values()))
+
+def fetch(cmd, cur, params=()):
     try:
-        cur.execute(cmd)
+        if(_profile is None):
+            cur.execute(cmd, params)
+            result = cur.fetchall()
+        else:
+            start = time.perf_counter()
+            cur.execute(cmd, params)
+            result = cur.fetchall()
+            _profile.record(cmd, time.perf_counter() - start, len(result), cur, params)
     except Exception as e:
         _sql_err(e, cmd)
+    return(result)
 
-def fetch(cmd, cur):
+def stream(cmd, cur, params=(), size=STREAM_ROWS):
+    '''
+    Like fetch, but yields the rows as the cursor produces them, size at a
+    time, so memory use does not grow with the result
+    '''
+    start = time.perf_counter()
+    nrows = 0
     try:
-        cur.execute(cmd)
-        result = cur.fetchall()
+        cur.execute(cmd, params)
+        while(True):
+            rows = cur.fetchmany(size)
+            if(not rows):
+                break
+            nrows += len(rows)
+            yield from rows
     except Exception as e:
         _sql_err(e, cmd)
+    if(_profile is not None):
+        _profile.record(cmd, time.perf_counter() - start, nrows, cur, params)
+
+def execute(cmd, cur, params=()):
+    try:
+        if(_profile is None):
+            cur.execute(cmd, params)
+        else:
+            start = time.perf_counter()
+            cur.execute(cmd, params)
+            _profile.record(cmd, time.perf_counter() - start, cur.rowcount, cur, params)
+    except Exception as e:
+        _sql_err(e, cmd)
+    return(cur.rowcount)
+
+def profile(slow=0.1, fh=sys.stderr):
+    '''
+    Turns on timing of every statement run through this module (slow is the
+    time in seconds above which a statement is logged with its query plan)
+    and returns the SQLProfile collecting them
+    '''
+    global _profile
+    _profile = sqlprofile.SQLProfile(slow=slow, fh=fh)
+    return(_profile)
+
+def fetch_in(cmd, values, cur, params=()):
+    '''
+    Runs cmd, whose '{}' stands for the values of an IN list, and returns
+    all rows. The values are bound, in fixed size batches for short lists
+    (so the statement text, and hence its cached plan, repeats) and through
+    the temporary table of temp_values for long ones. Positional params are
+    bound before the values.
+    '''
+    values = list(values)
+    if(len(values) > MAX_IN_VALUES):
+        table = temp_values(values, cur)
+        return(fetch(cmd.format('SELECT value FROM ' + table), cur, params))
+    result = []
+    for i in range(0, len(values), MAX_IN_VALUES):
+        batch = values[i:i + MAX_IN_VALUES]
+        result += fetch(cmd.format(_in_list(len(batch))), cur,
+                        tuple(params) + tuple(_pad(batch)))
     return(result)
 
+def execute_in(cmd, values, cur, params=()):
+    '''
+    Like fetch_in, for commands that return no rows
+    '''
+    values = list(values)
+    if(len(values) > MAX_IN_VALUES):
+        table = temp_values(values, cur)
+        return(execute(cmd.format('SELECT value FROM ' + table), cur, params))
+    count = 0
+    for i in range(0, len(values), MAX_IN_VALUES):
+        batch = values[i:i + MAX_IN_VALUES]
+        count += execute(cmd.format(_in_list(len(batch))), cur,
+                         tuple(params) + tuple(_pad(batch)))
+    return(count)
+
+def temp_values(values, cur, name='input_values'):
+    '''
+    Fills the temporary table temp.<name>(pos, value) with values, numbered
+    by position, and returns its qualified name. The table is analyzed, so
+    the planner knows it is small and joins from it into the report
+    indices (without statistics it drives the join from the report side,
+    building an automatic index on every call).
+    '''
+    table = 'temp.' + name
+    execute("CREATE TEMP TABLE IF NOT EXISTS {} "
+            "(pos INTEGER PRIMARY KEY, value)".format(name), cur)
+    execute("DELETE FROM " + table, cur)
+    insertmany(('pos', 'value'), enumerate(values), table, cur)
+    execute("ANALYZE " + table, cur)
+    return(table)
+
 
 # =====================
 # SQL COMMAND FUNCTIONS
 # =====================
 
-def open_db(filename):
+def open_db(filename, readonly=False):
+    '''
+    Opens a database for writing (switching it to WAL journaling, so readers
+    are not blocked by the writer) or, with readonly, through a mode=ro URI.
+    A read-only connection reads from one snapshot until it is committed
+    (see snapshot).
+    '''
     try:
-        con = sql.connect(filename)
+        if(readonly):
+            uri = 'file:{}?mode=ro'.format(
+                  urllib.request.pathname2url(os.path.abspath(filename)))
+            con = sql.connect(uri, uri=True, timeout=BUSY_TIMEOUT,
+                              cached_statements=STATEMENT_CACHE)
+        else:
+            con = sql.connect(filename, timeout=BUSY_TIMEOUT,
+                              cached_statements=STATEMENT_CACHE)
+            cur = con.cursor()
+            cur.execute('PRAGMA journal_mode = WAL')
+            cur.execute('PRAGMA synchronous = NORMAL')
+            cur.execute('PRAGMA wal_autocheckpoint = {}'.format(CHECKPOINT_PAGES))
+        con.create_function('alignment', 2, unpack_alignment, deterministic=True)
         return(con)
     except Exception as e:
         print("Error opening {}: {}".format(filename, e), file=sys.stderr)
         sys.exit(1)
 
-def get_query_info(ident, value, cur):
-    value = _quote(value)
-    ident = _ident2field(ident)
-    fields = (('query_seqid','seqid'),
-              ('query_locus','locus'),
-              ('query_taxon','taxon'),
-              ('query_gi','gi'),
-              ('query_gb','gb'),
-              ('iteration_query_len','length'))
-    cmd = "select distinct {} from blastreport where {} = {}".format(
-            ','.join([x[0] for x in fields]), ident, value)
-    results = fetch(cmd, cur)
-    out = [dict(zip([f[1] for f in fields], q)) for q in results]
-    return(out)
+def snapshot(cur):
+    '''
+    Starts a read transaction, so all following queries see the database as
+    it is now, whatever a concurrent writer commits. It lasts until the
+    connection commits.
+    '''
+    if(not cur.connection.in_transaction):
+        cur.execute('BEGIN')
+        # The snapshot is taken at the first read
+        cur.execute('SELECT count(*) FROM sqlite_master').fetchall()
+
+def checkpoint(cur, mode='PASSIVE'):
+    '''
+    Copies committed WAL pages into the database file. PASSIVE never waits
+    on readers; TRUNCATE (which also empties the WAL file) waits up to the
+    busy timeout for them. Returns True if the checkpoint was completed.
+    '''
+    cur.connection.commit()
+    busy, nlog, ndone = fetch('PRAGMA wal_checkpoint({})'.format(mode), cur)[0]
+    return(not busy and nlog == ndone)
+
+def bulk_mode(cur, on=True):
+    '''
+    Switches the database to (or back from) ingest friendly settings: no
+    fsyncs and a large page cache. Durability then rests on restarting the
+    load (see lib/manifest.py), not on each commit.
+    '''
+    cur.connection.commit()
+    if(on):
+        pragmas = ('synchronous = OFF', 'temp_store = MEMORY',
+                   'cache_size = -262144')
+    else:
+        pragmas = ('synchronous = NORMAL', 'temp_store = DEFAULT',
+                   'cache_size = -2000')
+    for pragma in pragmas:
+        fetch('PRAGMA ' + pragma, cur)
+
+def get_query_info_batch(ident, values, cur):
+    '''
+    Returns {value: info} with one info dict (the first row found) per
+    identifier present. The identifiers are joined against BlastReport from
+    a temporary table.
+    '''
+    table = temp_values(dict.fromkeys(values), cur, name='info_values')
+    cmd = '''select v.value, {} from {} v join blastreport r on r.{} = v.value
+             group by v.pos'''.format(
+             ','.join(['r.' + x[0] for x in QUERY_INFO_FIELDS]), table,
+             _ident2field(ident))
+    names = [f[1] for f in QUERY_INFO_FIELDS]
+    return({row[0]: dict(zip(names, row[1:])) for row in stream(cmd, cur)})
 
 def get_fields(fields, table, cur, ident=None, value=None, is_distinct=False):
     if(value):
-        value = _quote(value)
-        if(isinstance(value, str)):
-            condition = "where {} = {}".format(ident, value)
-        else:
-            condition = ' '.join(("where {} in (", ''.join(value), ")")).format(ident)
+        condition = "where {} in ({{}})".format(ident)
+        values = _as_list(value)
     else:
         condition = ''
+        values = None
 
     result = _prepare_simple_select(fields, table, condition, cur,
-                                    is_distinct=is_distinct)
+                                    is_distinct=is_distinct, values=values)
     return(result)
 
 def get_db(cur):
@@ -109,105 +356,114 @@ def get_db(cur):
                                     is_distinct=True)
     return(result)
 
-def spec(ident, value, criterion, cur):
-    value = _quote(value)
+def spec_batch(ident, values, criterion, cur):
+    '''
+    Returns {value: (hit phylostratum, found, species phylostratum)}: the
+    lowest phylostratum of a database with a hit meeting the criterion (None
+    if there is none), whether the identifier was found at all and, if no
+    hit qualified, the phylostratum of the query species. The identifiers
+    are joined against BlastReport from a temporary table in a single
+    grouped query.
+    '''
     if(criterion[0] == 'evalue'):
-        condition = 'hsp_evalue <=' + str(criterion[1])
+        condition = 'r.hsp_evalue <= ?'
     else:
-        condition = 'hsp_bit_score >=' + str(criterion[1])
-
-    column = _ident2field(ident)
-    cmd = """
-    select min(phylostratum) from mrca where
-        taxid_1 =
-        (
-            select distinct query_taxon from blastreport
-                where {0} = {1}
-        )
-    and
-        taxid_2 in
-        (
-            select distinct taxid from blastdatabase where database in
-            (
-                select distinct blastoutput_db from blastreport
-                    where {0} = {1} and {2}
-            )
-        )
-    ;""".format(column, value, condition)
-
-    out = fetch(cmd, cur)[0][0]
-
-    # If no result, check to ensure the input identifier exists
-    # If input exists, then the protein is specific to the input taxa,
-    # so find the highest possible phylostratum
-    if(out is None):
-        cmd = ''.join(("select distinct ", column,
-                       " from blastreport where ",
-                       column, " = ", value))
-        check = fetch(cmd, cur)
-        if(0 == len(check)):
-            print("Column {} does not contain value {}".format(column, value),
-                  " dying painfully...",
-                  file=sys.stderr)
-            sys.exit(1)
-        else:
-            cmd = ' '.join((
-                "select max(phylostratum) from mrca where taxid_1 = ",
-                "(select distinct query_taxon from blastreport",
-                "where {0} = {1})")).format(column, value)
-            species_ps = fetch(cmd, cur)[0][0]
-            out = species_ps
-    return(out)
+        condition = 'r.hsp_bit_score >= ?'
+
+    table = temp_values(sorted(set(values)), cur, name='spec_values')
+    cmd = SPEC_BATCH.format(_ident2field(ident), table, condition)
+
+    found = {value: (ps, True, species_ps)
+             for value, ps, species_ps in fetch(cmd, cur, (float(criterion[1]), ))}
+    return({x: found.get(x, (None, False, None)) for x in values})
 
-def table_exists(table, cur):
+def table_exists(table, cur, views=True):
+    # A view (such as the normalized BlastReport) counts unless views=False
+    types = ('table', 'view') if views else ('table', )
     cmd = """SELECT name
              FROM sqlite_master
-             WHERE type='table'
-             AND name='{}' COLLATE NOCASE""".format(table)
-    result = fetch(cmd, cur)
+             WHERE type IN ({})
+             AND name = ? COLLATE NOCASE""".format(', '.join('?' * len(types)))
+    result = fetch(cmd, cur, types + (table, ))
     table_exists = True if len(result) > 0 else False
     return(table_exists)
 
 def entry_exists(table, field, value, cur, condition=None):
-    value = _quote(value)
-    cmd = "select {0} from {1} where {0} = {2}".format(field, table, value)
-    result = fetch(cmd, cur)
+    cmd = "select {0} from {1} where {0} = ? limit 1".format(field, table)
+    result = fetch(cmd, cur, (value, ))
     entry_exists = True if len(result) > 0 else False
     return(entry_exists)
 
-def get_maxattr(fields, cur, condition=None):
-    # Retrieve all input fields where score is maximum for database/query pair
+def get_maxattr(fields, cur, condition=None, sort_keys=False):
+    # Retrieve all input fields of the best HSP of each database/query pair,
+    # chosen as in SELECT_BEST (with sort_keys, the phylostratum, mrca,
+    # database, seqid, hit and hsp are appended to each row, so rows from
+    # several shards can be merged). The condition is tested on the best
+    # row, as it is on the MaxHsp table.
     condition = "where {}".format(condition) if condition else ''
+    if(sort_keys):
+        fields = list(fields) + ['mrca.phylostratum', 'mrca.mrca', 'blastoutput_db',
+                                 'query_seqid', 'hit_num', 'hsp_num']
     cmd = ''' \
-            select blastdatabase.species, query_locus, max(hsp_bit_score), {}
+            select blastdatabase.species, query_locus, hsp_bit_score, {}
             from (
-                    ((blastreport inner join blastdatabase on
+                    (((select database as best_db, seqid as best_seqid,
+                              hit as best_hit, hsp as best_hsp,
+                              sciname as best_sciname
+                          from ({})) best
+                    inner join blastreport on
+                        blastreport.blastoutput_db=best.best_db and
+                        blastreport.query_seqid=best.best_seqid and
+                        blastreport.hit_num=best.best_hit and
+                        blastreport.hsp_num=best.best_hsp)
+                    inner join blastdatabase on
                         blastreport.blastoutput_db=blastdatabase.database)
                     inner join mrca on
                         blastreport.query_taxon=mrca.taxid_1 and
                         blastdatabase.taxid=mrca.taxid_2)
                     inner join taxid2name on
-                        mrca.mrca=taxid2name.taxid
-                 )
+                        mrca.mrca=taxid2name.taxid and
+                        taxid2name.sciname=best.best_sciname
             {}
-            group by blastoutput_db, query_locus
-            order by query_locus, mrca.phylostratum, mrca.mrca
-        '''.format(', '.join(fields), condition)
+            order by query_locus, mrca.phylostratum, mrca.mrca, blastoutput_db
+        '''.format(', '.join(fields), SELECT_BEST.format('blastreport r'), condition)
     return(fetch(cmd, cur))
 
+def pack_alignment(qseq, hseq, midline):
+    '''
+    Compresses the three alignment strings of an HSP into one BLOB
+    '''
+    text = '\n'.join(x or '' for x in (qseq, hseq, midline))
+    return(zlib.compress(text.encode()))
+
+def unpack_alignment(blob, part):
+    '''
+    Returns one part ('qseq', 'hseq' or 'midline') of a packed alignment,
+    registered as the SQL function alignment(blob, part)
+    '''
+    if(blob is None):
+        return None
+    text = zlib.decompress(blob).decode().split('\n')
+    return(text[ALIGNMENT_PARTS.index(part.lower())] or None)
+
+
 
 # =================
 # UTILITY FUNCTIONS
 # =================
 
-def _prepare_simple_select(fields, table, condition, cur, is_distinct=False):
+def _prepare_simple_select(fields, table, condition, cur, is_distinct=False,
+                           values=None):
     fields = fields if isinstance(fields, (tuple, list, set)) else (fields,)
     field_str = ', '.join(fields)
     dis_str = ' distinct ' if is_distinct else ''
 
     cmd = "select {} {} from {} {}".format(dis_str, field_str, table, condition)
 
-    result = fetch(cmd, cur)
+    if(values is None):
+        result = fetch(cmd, cur)
+    else:
+        result = fetch_in(cmd, values, cur)
 
     result = _unnest(result)
 
@@ -232,14 +488,25 @@ def _unnest(dat):
         return(dat)
     return(out)
 
-def _quote(x):
-    if(not isinstance(x, (list, tuple))):
-        if(x is None):
-            return 'NULL'
-        else:
-            return(''.join(("'", x, "'")))
-    else:
-        return([_quote(y) for y in x])
+def _as_list(value):
+    if(isinstance(value, (list, tuple, set))):
+        return(list(value))
+    return([value])
+
+def _in_size(n):
+    # IN lists are padded to a power of two, so few distinct statements result
+    size = 1
+    while(size < n):
+        size *= 2
+    return(size)
+
+@functools.lru_cache(maxsize=None)
+def _in_list(n):
+    return(', '.join('?' * _in_size(n)))
+
+def _pad(values):
+    # Repeating a value does not change the result of an IN test
+    return(values + values[-1:] * (_in_size(len(values)) - len(values)))
 
 def _sql_err(e, cmd):
     print("Error on command\n{}".format(cmd))
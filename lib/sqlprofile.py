@@ -0,0 +1,106 @@
+#! /usr/bin/python3
+
+import json
+import re
+import sys
+
+# =========
+# CONSTANTS
+# =========
+
+# Literals and bound value lists that are replaced by '?' when grouping
+# statements, so 'where x = 1' and 'where x = 2' count as one statement
+LITERALS = re.compile(r"""'(?:[^']|'')*'|(?<![\w.])-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?\b""")
+VALUE_LISTS = re.compile(r'\?(?:\s*,\s*\?)+')
+SPACE = re.compile(r'\s+')
+
+# Statements listed in the summary
+SUMMARY_LINES = 20
+
+
+class SQLProfile:
+    '''
+    Collects the wall time, row count and number of calls of every statement
+    run through sqlite_interface, grouped by normalized SQL text. Statements
+    slower than slow seconds are logged with their query plan.
+    '''
+    def __init__(self, slow=0.1, fh=sys.stderr):
+        self.slow = slow
+        self.fh = fh
+        self.stats = {}
+        self.slow_log = []
+
+    def record(self, cmd, seconds, rows, cur=None, params=()):
+        key = normalize(cmd)
+        try:
+            stat = self.stats[key]
+        except KeyError:
+            stat = self.stats[key] = {'calls': 0, 'seconds': 0.0, 'max': 0.0, 'rows': 0}
+        stat['calls'] += 1
+        stat['seconds'] += seconds
+        stat['max'] = max(stat['max'], seconds)
+        stat['rows'] += max(rows, 0)
+        if(self.slow is not None and seconds >= self.slow):
+            plan = self._plan(cmd, cur, params)
+            self.slow_log.append({'sql': key, 'seconds': round(seconds, 6),
+                                  'rows': rows, 'plan': plan})
+            print("Slow statement ({:.3f}s, {} rows): {}".format(seconds, rows, key),
+                  file=self.fh)
+            for line in plan:
+                print("    " + line, file=self.fh)
+
+    def _plan(self, cmd, cur, params):
+        if(cur is None or not cmd.lstrip().lower().startswith(('select', 'with', 'update', 'delete'))):
+            return([])
+        try:
+            # A separate cursor leaves the caller's results alone
+            rows = cur.connection.execute('EXPLAIN QUERY PLAN ' + cmd, params).fetchall()
+        except Exception as e:
+            return(['(no plan: {})'.format(e)])
+        # Rows are (id, parent, notused, detail), indent by depth
+        depth = {0: -1}
+        out = []
+        for node, parent, _, detail in rows:
+            depth[node] = depth.get(parent, -1) + 1
+            out.append('  ' * depth[node] + detail)
+        return(out)
+
+    def summary(self, fh=None):
+        fh = fh or self.fh
+        total = sum(s['seconds'] for s in self.stats.values())
+        ncalls = sum(s['calls'] for s in self.stats.values())
+        print("SQL: {} calls of {} statements in {:.3f}s".format(
+              ncalls, len(self.stats), total), file=fh)
+        print("{:>9} {:>9} {:>9} {:>10}  {}".format(
+              'calls', 'total(s)', 'max(s)', 'rows', 'statement'), file=fh)
+        ranked = sorted(self.stats.items(), key=lambda x: -x[1]['seconds'])
+        for key, s in ranked[:SUMMARY_LINES]:
+            print("{:>9} {:>9.3f} {:>9.4f} {:>10}  {}".format(
+                  s['calls'], s['seconds'], s['max'], s['rows'], _shorten(key)),
+                  file=fh)
+
+    def dump(self, filename):
+        ranked = sorted(self.stats.items(), key=lambda x: -x[1]['seconds'])
+        out = {'statements': [{'sql'     : k,
+                               'calls'   : v['calls'],
+                               'seconds' : round(v['seconds'], 6),
+                               'max'     : round(v['max'], 6),
+                               'rows'    : v['rows']} for k, v in ranked],
+               'slow': self.slow_log}
+        with open(filename, 'w') as f:
+            json.dump(out, f, indent=2)
+            f.write('\n')
+
+
+def normalize(cmd):
+    cmd = LITERALS.sub('?', cmd)
+    cmd = VALUE_LISTS.sub('?, ...', cmd)
+    return(SPACE.sub(' ', cmd).strip())
+
+
+# =================
+# UTILITY FUNCTIONS
+# =================
+
+def _shorten(text, width=100):
+    return(text if len(text) <= width else text[:width - 3] + '...')
@@ -0,0 +1,303 @@
+#! /usr/bin/python3
+
+import os
+import pickle
+import resource
+import sys
+import tempfile
+
+import lib.sqlite_interface as misc
+
+# =========
+# CONSTANTS
+# =========
+
+BATCH_ROWS = 10000
+BATCH_BYTES = 64 * 2**20
+
+ALIGNMENT_TABLE = 'HspAlignment'
+ALIGNMENT_FIELDS = ('hsp_qseq', 'hsp_hseq', 'hsp_midline')
+KEY_FIELDS = ('blastoutput_db', 'query_seqid', 'hit_num', 'hsp_num')
+
+# Normalized layout (see initialize.init_normalized), by column prefix
+QUERY_PREFIXES = ('iteration_', 'statistics_', 'query_')
+
+
+# =======
+# WRITERS
+# =======
+
+class _BatchWriter:
+    '''
+    Buffers rows grouped by table and column tuple and hands them on whenever
+    the buffer holds more than max_rows rows or max_bytes bytes of field
+    text. With pack, alignment strings are moved out of the row into a
+    compressed HspAlignment row.
+    '''
+    def __init__(self, table='BlastReport', max_rows=BATCH_ROWS,
+                 max_bytes=BATCH_BYTES, pack=False):
+        self.table = table
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.pack = pack
+        self.plans = {}
+        self.row_by_col = {}
+        self.nrows = 0
+        self.nbytes = 0
+        # High-water marks and totals
+        self.peak_rows = 0
+        self.peak_bytes = 0
+        self.total_rows = 0
+        self.batches = 0
+
+    def add(self, col, row):
+        if(self.pack):
+            col, row = self._pack(col, row)
+        self._buffer(self.table, col, row)
+
+    def _buffer(self, table, col, row):
+        try:
+            self.row_by_col[(table, col)].append(row)
+        except KeyError:
+            self.row_by_col[(table, col)] = [row]
+        self.nrows += 1
+        self.nbytes += _row_size(row)
+        if(self.nrows >= self.max_rows or self.nbytes >= self.max_bytes):
+            self.flush()
+
+    def _pack(self, col, row):
+        try:
+            plan = self.plans[col]
+        except KeyError:
+            plan = self.plans[col] = _pack_plan(col)
+        if(plan is None):
+            return((col, row))
+        keep_col, keep_idx, key_idx, aln_idx = plan
+        aln = misc.pack_alignment(*[None if i is None else row[i] for i in aln_idx])
+        self._buffer(ALIGNMENT_TABLE, KEY_FIELDS + ('alignment', ),
+                     tuple(row[i] for i in key_idx) + (aln, ))
+        return((keep_col, tuple(row[i] for i in keep_idx)))
+
+    def flush(self):
+        if(not self.row_by_col):
+            return
+        self.peak_rows = max(self.peak_rows, self.nrows)
+        self.peak_bytes = max(self.peak_bytes, self.nbytes)
+        self.total_rows += self.nrows
+        self.batches += 1
+        self._write(self.row_by_col)
+        self.row_by_col = {}
+        self.nrows = 0
+        self.nbytes = 0
+
+    def _write(self, row_by_col):
+        raise NotImplementedError
+
+class RowWriter(_BatchWriter):
+    '''
+    Writes batches of rows into SQL tables, committing after each batch so
+    neither the buffer nor the open transaction grows with the input. With
+    normalized, each flat BlastReport row is split into BlastRun, BlastQuery,
+    BlastHit and BlastHsp rows, writing each run, query and hit only once.
+    With shards (a shard.ShardSet), report rows go to the shard of their
+    key and only the manifest rows to cur.
+    '''
+    def __init__(self, cur, normalized=False, shards=None, **kwargs):
+        super().__init__(**kwargs)
+        self.cur = cur
+        self.normalized = normalized
+        self.shards = shards
+        self.split_plans = {}
+        self.run_ids = {}
+        self.last_query = None
+        self.last_hit = None
+        # When set to a manifest path, the (database, query) keys of the
+        # written rows are recorded in LoadedQuery in the same transaction.
+        # Without a path, they are passed to notify (if set) instead.
+        self.source = None
+        self.notify = None
+        self.keys = set()
+        self.key_index = {}
+
+    def _buffer(self, table, col, row):
+        if(table == self.table and
+           (self.source is not None or self.notify is not None)):
+            try:
+                i, j = self.key_index[col]
+            except KeyError:
+                lower = [x.lower() for x in col]
+                i, j = self.key_index[col] = (lower.index('blastoutput_db'),
+                                              lower.index('query_seqid'))
+            self.keys.add((row[i], row[j]))
+        if(self.normalized and table == self.table):
+            self._split(col, row)
+        else:
+            super()._buffer(table, col, row)
+
+    def _split(self, col, row):
+        try:
+            plan = self.split_plans[col]
+        except KeyError:
+            plan = self.split_plans[col] = _split_plan(col)
+        run_col, run_idx, query_col, query_idx, hit_col, hit_idx, hsp_col, hsp_idx = plan
+
+        if(self.shards is None):
+            key, cur = None, self.cur
+        else:
+            key = self.shards.key(col, row)
+            cur = self.shards.cursor(key)
+        run_id = self._run_id(run_col, tuple(row[i] for i in run_idx), cur, key)
+        qrow = tuple(row[i] for i in query_idx) + (run_id, )
+        if(qrow[:2] != self.last_query):
+            self.last_query = qrow[:2]
+            self.last_hit = None
+            super()._buffer('BlastQuery', query_col, qrow)
+        if(hit_idx is None):
+            return
+        hrow = tuple(row[i] for i in hit_idx)
+        if(hrow[:3] != self.last_hit):
+            self.last_hit = hrow[:3]
+            super()._buffer('BlastHit', hit_col, hrow)
+        super()._buffer('BlastHsp', hsp_col, tuple(row[i] for i in hsp_idx))
+
+    def _run_id(self, col, row, cur, shard_key=None):
+        '''
+        Returns the BlastRun id for a set of program and parameter values,
+        adding a BlastRun row the first time they are seen
+        '''
+        try:
+            return(self.run_ids[(shard_key, col, row)])
+        except KeyError:
+            pass
+        cmd = "SELECT run_id FROM BlastRun WHERE {}".format(
+              ' AND '.join('{} IS ?'.format(c) for c in col))
+        found = misc.fetch(cmd, cur, row)
+        if(found):
+            run_id = found[0][0]
+        else:
+            misc.insert(dict(zip(col, row)), 'BlastRun', cur)
+            run_id = cur.lastrowid
+        self.run_ids[(shard_key, col, row)] = run_id
+        return(run_id)
+
+    def _write(self, row_by_col):
+        for (table, col), rows in row_by_col.items():
+            if(self.shards is None):
+                misc.insertmany(col, rows, table, self.cur, replace=True)
+                continue
+            for key, part in self.shards.partition(col, rows):
+                misc.insertmany(col, part, table, self.shards.cursor(key), replace=True)
+        if(self.shards is not None):
+            # Before the manifest rows that vouch for them
+            self.shards.commit()
+        if(self.keys and self.source is not None):
+            misc.insertmany(('path', 'database', 'query_seqid'),
+                            [(self.source, ) + k for k in self.keys],
+                            'LoadedQuery', self.cur, replace=True)
+        elif(self.keys):
+            self.notify(self.keys, self.cur)
+        self.keys = set()
+        self.cur.connection.commit()
+
+    def replay(self, filename):
+        '''
+        Writes (and then deletes) the batches spooled by a SpoolWriter
+        '''
+        with open(filename, 'rb') as f:
+            while(True):
+                try:
+                    row_by_col = pickle.load(f)
+                except EOFError:
+                    break
+                for (table, col), rows in row_by_col.items():
+                    for row in rows:
+                        self._buffer(table, col, row)
+        os.remove(filename)
+
+    def report(self, fh=sys.stderr):
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        peak_child = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        print("Wrote {} rows in {} batches".format(self.total_rows, self.batches),
+              file=fh)
+        print("Peak buffer: {} rows, {} bytes".format(self.peak_rows, self.peak_bytes),
+              file=fh)
+        print("Peak RSS: {} KiB (largest worker: {} KiB)".format(peak_rss, peak_child),
+              file=fh)
+
+class SpoolWriter(_BatchWriter):
+    '''
+    Pickles batches to a temporary file (in directory, if given), used by
+    worker processes which do not own the database connection
+    '''
+    def __init__(self, directory=None, **kwargs):
+        super().__init__(**kwargs)
+        fd, self.filename = tempfile.mkstemp(prefix='blastdbm-', suffix='.spool',
+                                             dir=directory)
+        self.fh = os.fdopen(fd, 'wb')
+
+    def _write(self, row_by_col):
+        pickle.dump(row_by_col, self.fh, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def close(self):
+        self.flush()
+        self.fh.close()
+        return(self.filename)
+
+
+# =================
+# UTILITY FUNCTIONS
+# =================
+
+def _pack_plan(col):
+    '''
+    Works out which positions of a row with columns col hold the alignment
+    strings, the HspAlignment key and the remaining BlastReport columns.
+    Returns None if the row has no alignment to pack.
+    '''
+    lower = [x.lower() for x in col]
+    if(not any(x in lower for x in ALIGNMENT_FIELDS) or
+       not all(x in lower for x in KEY_FIELDS)):
+        return(None)
+    keep_idx = [i for i, x in enumerate(lower) if x not in ALIGNMENT_FIELDS]
+    keep_col = tuple(col[i] for i in keep_idx)
+    key_idx = [lower.index(x) for x in KEY_FIELDS]
+    aln_idx = [lower.index(x) if x in lower else None for x in ALIGNMENT_FIELDS]
+    return((keep_col, keep_idx, key_idx, aln_idx))
+
+def _split_plan(col):
+    '''
+    Works out which positions of a flat BlastReport row go to each table of
+    the normalized layout. Each table's columns start with its key.
+    '''
+    lower = [x.lower() for x in col]
+    run, query, hit, hsp = [], [], [], []
+    for i, x in enumerate(lower):
+        if(x in KEY_FIELDS):
+            continue
+        elif(x.startswith('hsp_')):
+            hsp.append(i)
+        elif(x.startswith('hit_')):
+            hit.append(i)
+        elif(x.startswith(QUERY_PREFIXES)):
+            query.append(i)
+        else:
+            run.append(i)
+    db, qseqid = lower.index('blastoutput_db'), lower.index('query_seqid')
+    query_idx = [db, qseqid] + query
+    query_col = tuple(col[i] for i in query_idx) + ('run_id', )
+    if('hit_num' in lower):
+        hit_idx = [db, qseqid, lower.index('hit_num')] + hit
+        hit_col = tuple(col[i] for i in hit_idx)
+    else:
+        hit_idx, hit_col = None, None
+    if('hit_num' in lower and 'hsp_num' in lower):
+        hsp_idx = [db, qseqid, lower.index('hit_num'), lower.index('hsp_num')] + hsp
+        hsp_col = tuple(col[i] for i in hsp_idx)
+    else:
+        hit_idx, hit_col = None, None
+        hsp_idx, hsp_col = None, None
+    return((tuple(col[i] for i in run), run, query_col, query_idx,
+            hit_col, hit_idx, hsp_col, hsp_idx))
+
+def _row_size(row):
+    return(sum(len(x) for x in row if isinstance(x, (str, bytes))))